@@ -5,3 +5,4 @@ EXPERIMENTS_PATH = "/Users/ketai/Library/CloudStorage/OneDrive-USI/Thesis/experi
 FAILURE_INJECTION_PATH = os.path.join(EXPERIMENTS_PATH, "failure injection")
 NORMAL_METRICS_PATH = os.path.join(EXPERIMENTS_PATH, "normal")
 GCLOUD_METRICS_PATH = os.path.join(NORMAL_METRICS_PATH, "gcloud-metrics")
+GCLOUD_API_CACHE_PATH = os.path.join(EXPERIMENTS_PATH, "gcloud_api_cache.json")
@@ -1,16 +1,23 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import os
+import shutil
 
 import pandas as pd
-from app import NORMAL_METRICS_PATH
+from app import GCLOUD_API_CACHE_PATH, NORMAL_METRICS_PATH
+from app.collection_manifest import CollectionManifest
 from app.gcloud_apis import GCloudAPI
+from app.model.gaggregation import GAggregation
 from app.model.gmetric import GMetric
+from app.model.gmetric_store import GMetricStore
 from app.model.metric_kind import MetricKind
 from app.model.resource_label import ResourceLabel
 import time
 
 TARGET_NAMESPACE = "alms"
+GCLOUD_SOURCE = "gcloud"
+STORAGE_FORMATS = ["csv", "parquet"]
 
 
 def extract_resource_type(metric_desc):
@@ -26,7 +33,80 @@ def extract_resource_type(metric_desc):
         return metric_desc.monitored_resource_types[0]
 
 
-def collect_metrics_by_prefix(start: str, end: str, metrics_dir_suffix: str = ""):
+def write_time_series(
+    time_series_pages, output_path: str, metric_type_index: int, storage_format: str
+) -> list:
+    """
+    Write each time series of a metric type as a KPI and return the paths of
+    the written files. The "csv" storage format writes one CSV file per KPI,
+    while "parquet" writes all KPIs of the metric type in one columnar file.
+    """
+    if storage_format == "parquet":
+        with GMetricStore(output_path, metric_type_index) as store:
+            kpi_index = 1
+            for time_series in time_series_pages:
+                gmetric = GMetric.from_time_series(time_series)
+                store.write_kpi(gmetric, kpi_index)
+                kpi_index += 1
+        return [store.path] if os.path.exists(store.path) else []
+    elif storage_format == "csv":
+        kpi_index = 1
+        for time_series in time_series_pages:
+            gmetric = GMetric.from_time_series(time_series)
+            gmetric.write_kpi(output_path, metric_type_index, kpi_index)
+            kpi_index += 1
+        return GMetric.list_kpi_files(output_path, metric_type_index)
+    else:
+        raise ValueError(
+            f"Unsupported storage format {storage_format}, use one of {STORAGE_FORMATS}!"
+        )
+
+
+def collect_metric_type(
+    gcloud_api: GCloudAPI,
+    metric_desc,
+    start: str,
+    end: str,
+    output_path: str,
+    metric_type_index: int,
+    storage_format: str = "csv",
+    aggregation: GAggregation = None,
+) -> list:
+    """
+    Collect time series of a metric type and return the paths of the written
+    files. This is run on worker threads, so it only writes files of its own
+    metric type. If `aggregation` is given, time series are aligned and
+    reduced by Cloud Monitoring instead of collecting raw points.
+    """
+    logging.info(f"Processing metric type {metric_desc.type} ...")
+    resource_labels = gcloud_api.get_resource_labels(extract_resource_type(metric_desc))
+    if aggregation is not None:
+        aggregation = aggregation.to_aggregation(metric_desc)
+    if ResourceLabel.NAMESPACE.value in resource_labels:
+        # consider only metrics from the target namespace
+        time_series_pages = gcloud_api.get_time_series(
+            metric_desc.type,
+            start,
+            end,
+            namespace=TARGET_NAMESPACE,
+            aggregation=aggregation,
+        )
+    else:
+        time_series_pages = gcloud_api.get_time_series(
+            metric_desc.type, start, end, aggregation=aggregation
+        )
+    return write_time_series(
+        time_series_pages, output_path, metric_type_index, storage_format
+    )
+
+
+def collect_metrics_by_prefix(
+    start: str,
+    end: str,
+    metrics_dir_suffix: str = "",
+    max_workers: int = 1,
+    aggregation: GAggregation = None,
+):
     """
     Collect metrics of the experiment.
 
@@ -38,112 +118,186 @@ def collect_metrics_by_prefix(start: str, end: str, metrics_dir_suffix: str = ""
         end time of the experiment in ISO8601 format
     metrics_dir_suffix : str
         directory name suffix of metrics
+    max_workers : int
+        number of metric types collected concurrently
+    aggregation : GAggregation
+        server-side aggregation of time series, default is None, which means
+        to collect raw points
     """
-    metric_type_index = 1
-    gcloud_api = GCloudAPI()
+    gcloud_api = GCloudAPI(cache_path=GCLOUD_API_CACHE_PATH)
     metric_type_prefixes = gcloud_api.gen_all_metric_type_prefixes()
-    for prefix in metric_type_prefixes:
-        metric_descriptors = gcloud_api.get_metric_descriptors(prefix)
-        for metric_desc in metric_descriptors:
-            logging.info(f"Processing metric type {metric_desc.type} ...")
+    gcloud_metrics_path = os.path.join(metrics_dir_suffix, GMetric.METRICS_DIR_NAME)
+    if not os.path.exists(gcloud_metrics_path):
+        os.mkdir(gcloud_metrics_path)
+    metric_descriptors = [
+        metric_desc
+        for prefix in metric_type_prefixes
+        for metric_desc in gcloud_api.get_metric_descriptors(prefix)
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for metric_type_index, metric_desc in enumerate(metric_descriptors, start=1):
             if GMetric.metric_type_exists(metrics_dir_suffix, metric_desc.type):
-                metric_type_index += 1
                 continue
-            # store metric type
+            # store metric type in order before collecting it concurrently
             GMetric.write_metric_type(
-                metrics_dir_suffix, metric_type_index, metric_desc.type
-            )
-            # collect time series
-            resource_labels = gcloud_api.get_resource_labels(
-                extract_resource_type(metric_desc)
+                metrics_dir_suffix,
+                metric_type_index,
+                metric_desc.type,
+                metric_desc.metric_kind,
             )
-            if ResourceLabel.NAMESPACE.value in resource_labels:
-                # consider only metrics from the target namespace
-                time_series_pages = gcloud_api.get_time_series(
-                    metric_desc.type, start, end, namespace=TARGET_NAMESPACE
-                )
-            else:
-                time_series_pages = gcloud_api.get_time_series(
-                    metric_desc.type, start, end
+            futures.append(
+                executor.submit(
+                    collect_metric_type,
+                    gcloud_api,
+                    metric_desc,
+                    start,
+                    end,
+                    metrics_dir_suffix,
+                    metric_type_index,
+                    aggregation=aggregation,
                 )
-            kpi_index = 1
-            for time_series in time_series_pages:
-                gmetric = GMetric.from_time_series(time_series)
-                gmetric.write_kpi(metrics_dir_suffix, metric_type_index, kpi_index)
-                kpi_index += 1
-            metric_type_index += 1
+            )
+        for future in as_completed(futures):
+            future.result()
+    gcloud_api.save_cache()
 
 
-def collect_known_gcloud_metrics(start: str, end: str, output_path: str = ""):
+def collect_known_gcloud_metrics(
+    start: str,
+    end: str,
+    output_path: str = "",
+    storage_format: str = "csv",
+    aggregation: GAggregation = None,
+):
     df_target_metrics = pd.read_csv(
         os.path.join(NORMAL_METRICS_PATH, "gcloud_target_metrics.csv")
     ).set_index("index")
-    gcloud_api = GCloudAPI()
+    gcloud_api = GCloudAPI(cache_path=GCLOUD_API_CACHE_PATH)
     for metric_type_index in df_target_metrics.index:
         metric_type = df_target_metrics.loc[metric_type_index]["name"]
         metric_descriptors = gcloud_api.get_metric_descriptors_by_name(metric_type)
         for metric_desc in metric_descriptors:
-            print(f"Processing metric type {metric_desc.type} ...")
-            # collect time series
-            resource_labels = gcloud_api.get_resource_labels(
-                extract_resource_type(metric_desc)
+            collect_metric_type(
+                gcloud_api,
+                metric_desc,
+                start,
+                end,
+                output_path,
+                metric_type_index,
+                storage_format,
+                aggregation,
             )
-            if ResourceLabel.NAMESPACE.value in resource_labels:
-                # consider only metrics from the target namespace
-                time_series_pages = gcloud_api.get_time_series(
-                    metric_desc.type, start, end, namespace=TARGET_NAMESPACE
-                )
-            else:
-                time_series_pages = gcloud_api.get_time_series(
-                    metric_desc.type, start, end
-                )
-            kpi_index = 1
-            for time_series in time_series_pages:
-                gmetric = GMetric.from_time_series(time_series)
-                gmetric.write_kpi(output_path, metric_type_index, kpi_index)
-                kpi_index += 1
+    gcloud_api.save_cache()
+
 
+def collect_all_gcloud_metrics(
+    start: str,
+    end: str,
+    output_path: str = "",
+    storage_format: str = "csv",
+    max_workers: int = 1,
+    aggregation: GAggregation = None,
+):
+    """
+    Collect all metric types of the experiment. Metric types already collected
+    and verified in the collection manifest are skipped, so that an interrupted
+    collection can be resumed.
+
+    Metric types are collected concurrently on a pool of `max_workers`
+    threads sharing one client. Their indices are assigned from the order of
+    the metric descriptors before collecting, so the output is the same as
+    collecting them one after another.
 
-def collect_all_gcloud_metrics(start: str, end: str, output_path: str = ""):
-    metric_type_index = 1
-    gcloud_api = GCloudAPI()
+    Parameters
+    ----------
+    start : str
+        start time of the experiment in ISO8601 format
+    end : str
+        end time of the experiment in ISO8601 format
+    output_path : str
+        path to the experiment folder
+    storage_format : str
+        "csv" to write one CSV file per KPI or "parquet" to write one columnar
+        file per metric type, see `write_time_series`
+    max_workers : int
+        number of metric types collected concurrently
+    aggregation : GAggregation
+        server-side aggregation of time series, e.g. `GAggregation()` to get
+        points aligned to minutes, default is None, which means to collect
+        raw points
+    """
+    gcloud_api = GCloudAPI(cache_path=GCLOUD_API_CACHE_PATH)
     metric_type_prefixes = gcloud_api.gen_all_metric_type_prefixes()
     gcloud_metrics_path = os.path.join(output_path, GMetric.METRICS_DIR_NAME)
     if not os.path.exists(gcloud_metrics_path):
         os.mkdir(gcloud_metrics_path)
-    for prefix in metric_type_prefixes:
-        metric_descriptors = gcloud_api.get_metric_descriptors(prefix)
-        for metric_desc in metric_descriptors:
-            print(f"Processing metric type {metric_desc.type} ...")
-            if GMetric.metric_type_exists(output_path, metric_desc.type):
-                metric_type_index += 1
+    metric_descriptors = [
+        metric_desc
+        for prefix in metric_type_prefixes
+        for metric_desc in gcloud_api.get_metric_descriptors(prefix)
+    ]
+    window = f"{start}-{end}"
+    manifest = CollectionManifest.load(output_path)
+    stored_metric_types = GMetric.read_metric_types(output_path)
+    # metric types collected before the manifest was kept are only recorded in
+    # the metric type map, record their files as they are
+    for metric_type_index, metric_desc in enumerate(metric_descriptors, start=1):
+        if (
+            metric_desc.type in stored_metric_types
+            and manifest.get_status(GCLOUD_SOURCE, metric_desc.type, window)
+            == "missing"
+        ):
+            store_path = GMetricStore.get_store_path(output_path, metric_type_index)
+            kpi_files = GMetric.list_kpi_files(output_path, metric_type_index)
+            if os.path.exists(store_path):
+                kpi_files.append(store_path)
+            manifest.mark_done(GCLOUD_SOURCE, metric_desc.type, window, kpi_files)
+    jobs_left = set(
+        manifest.report(
+            GCLOUD_SOURCE,
+            [(metric_desc.type, window) for metric_desc in metric_descriptors],
+        )
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict()
+        for metric_type_index, metric_desc in enumerate(metric_descriptors, start=1):
+            if (metric_desc.type, window) not in jobs_left:
                 continue
-            # store metric type
-            GMetric.write_metric_type(
+            manifest.mark_started(GCLOUD_SOURCE, metric_desc.type, window)
+            # store metric type in order before collecting it concurrently
+            if metric_desc.type not in stored_metric_types:
+                GMetric.write_metric_type(
+                    output_path,
+                    metric_type_index,
+                    metric_desc.type,
+                    metric_desc.metric_kind,
+                )
+            # discard KPIs of an interrupted or corrupted collection
+            kpi_dir = GMetric.get_kpi_dir(output_path, metric_type_index)
+            if os.path.exists(kpi_dir):
+                shutil.rmtree(kpi_dir)
+            store_path = GMetricStore.get_store_path(output_path, metric_type_index)
+            if os.path.exists(store_path):
+                os.remove(store_path)
+            future = executor.submit(
+                collect_metric_type,
+                gcloud_api,
+                metric_desc,
+                start,
+                end,
                 output_path,
                 metric_type_index,
-                metric_desc.type,
-                metric_desc.metric_kind,
-            )
-            # collect time series
-            resource_labels = gcloud_api.get_resource_labels(
-                extract_resource_type(metric_desc)
+                storage_format,
+                aggregation,
             )
-            if ResourceLabel.NAMESPACE.value in resource_labels:
-                # consider only metrics from the target namespace
-                time_series_pages = gcloud_api.get_time_series(
-                    metric_desc.type, start, end, namespace=TARGET_NAMESPACE
-                )
-            else:
-                time_series_pages = gcloud_api.get_time_series(
-                    metric_desc.type, start, end
-                )
-            kpi_index = 1
-            for time_series in time_series_pages:
-                gmetric = GMetric.from_time_series(time_series)
-                gmetric.write_kpi(output_path, metric_type_index, kpi_index)
-                kpi_index += 1
-            metric_type_index += 1
+            futures[future] = metric_desc.type
+        # the manifest is only updated from this thread
+        for future in as_completed(futures):
+            kpi_files = future.result()
+            manifest.mark_done(GCLOUD_SOURCE, futures[future], window, kpi_files)
+    manifest.save()
+    gcloud_api.save_cache()
 
 
 def get_metric_kind():
@@ -151,13 +305,14 @@ def get_metric_kind():
         os.path.join(NORMAL_METRICS_PATH, "gcloud_target_metrics.csv")
     ).set_index("index")
     metric_kinds = []
-    gcloud_api = GCloudAPI()
+    gcloud_api = GCloudAPI(cache_path=GCLOUD_API_CACHE_PATH)
     for metric_type_index in df_target_metrics.index:
         metric_type = df_target_metrics.loc[metric_type_index]["name"]
         metric_descriptors = gcloud_api.get_metric_descriptors_by_name(metric_type)
         for metric_desc in metric_descriptors:
             metric_kinds.append(metric_desc.metric_kind)
             break
+    gcloud_api.save_cache()
     df_target_metrics["kind"] = metric_kinds
     df_target_metrics.reset_index().to_csv(
         os.path.join(NORMAL_METRICS_PATH, "gcloud_target_metrics.csv"), index=False
@@ -15,7 +15,13 @@ from app.collect_prometheus_metrics import (
 
 
 def collect_metrics(
-    username: str, password: str, start: str, end: str, output_path: str
+    username: str,
+    password: str,
+    start: str,
+    end: str,
+    output_path: str,
+    max_concurrency: int = 1,
+    stream: bool = False,
 ):
     # collect GCloud time series
     # collect_known_gcloud_metrics(
@@ -23,9 +29,17 @@ def collect_metrics(
     #     end,
     #     output_path,
     # )
-    collect_all_gcloud_metrics(start, end, output_path)
+    collect_all_gcloud_metrics(start, end, output_path, max_workers=max_concurrency)
     # collect Prometheus time series
-    collect_known_prometheus_metrics(username, password, start, end, output_path)
+    collect_known_prometheus_metrics(
+        username,
+        password,
+        start,
+        end,
+        output_path,
+        max_concurrency,
+        stream=stream,
+    )
 
 
 def collect_metrics_for_all_faulty_experiments(username: str, password: str):
@@ -1,15 +1,113 @@
 # fetch APIs every 10s
 import pandas as pd
 from app import NORMAL_METRICS_PATH
-from app.prometheus_apis import PrometheusAPI
-import time, argparse, datetime, json, os
+from app.collection_manifest import CollectionManifest
+from app.prometheus_apis import AsyncPrometheusAPI, PrometheusAPI
+import asyncio, time, argparse, datetime, json, os
+
+PROMETHEUS_SOURCE = "prometheus"
+
+
+def gen_day_windows(start: str, end: str) -> list:
+    """
+    Split the experiment into windows of one day.
+
+    Returns a list of (day_count, start_timestamp, end_timestamp) tuples, where
+    both timestamps are Unix timestamps in seconds and inclusive.
+    """
+    experiment_start = datetime.datetime.fromisoformat(start)
+    experiment_end = datetime.datetime.fromisoformat(end)
+    windows = []
+    day_count = 1
+    start = experiment_start
+    while start < experiment_end:
+        end = start + datetime.timedelta(days=1) - datetime.timedelta(seconds=1)
+        if end > experiment_end:
+            end = experiment_end
+        windows.append((day_count, int(start.timestamp()), int(end.timestamp())))
+        start += datetime.timedelta(days=1)
+        day_count += 1
+    return windows
+
+
+def prepare_metrics_dir(metric_names: list, output_path: str) -> str:
+    """Create the metrics directory and store the map of metric names."""
+    metrics_dir = os.path.join(output_path, "prometheus-metrics")
+    if not os.path.exists(metrics_dir):
+        os.mkdir(metrics_dir)
+    metric_names_map = dict(
+        [(index + 1, metric_name) for index, metric_name in enumerate(metric_names)]
+    )
+    with open(os.path.join(metrics_dir, "metric_names_map.json"), "w") as fp:
+        json.dump(metric_names_map, fp, indent=4)
+    return metrics_dir
+
+
+def gen_jobs_left(
+    manifest: CollectionManifest, metric_names: list, windows: list
+) -> set:
+    """Report (metric, window) jobs of the manifest and return the unfinished ones."""
+    jobs = [
+        (name, f"{start_timestamp}-{end_timestamp}")
+        for _, start_timestamp, end_timestamp in windows
+        for name in metric_names
+    ]
+    return set(manifest.report(PROMETHEUS_SOURCE, jobs))
+
+
+def write_range_metric(metric_file: str, range_metric: dict):
+    with open(metric_file, "w") as fp:
+        json.dump(range_metric, fp, separators=(",", ":"))
+
+
+class RangeMetricWriter:
+    """
+    Write series of a range metric one at a time in the same layout as
+    `write_range_metric`. The file is written under a temporary name and only
+    renamed once complete, so an interrupted stream leaves no valid file.
+    """
+
+    def __init__(self, metric_file: str):
+        self.metric_file = metric_file
+        self.part_file = f"{metric_file}.part"
+        self.fp = None
+        self.num_series = 0
+
+    def __enter__(self) -> "RangeMetricWriter":
+        self.fp = open(self.part_file, "w")
+        self.fp.write('{"resultType":"matrix","result":[')
+        return self
+
+    def write(self, item: dict):
+        if self.num_series > 0:
+            self.fp.write(",")
+        json.dump(item, self.fp, separators=(",", ":"))
+        self.num_series += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.fp.write("]}")
+        self.fp.close()
+        if exc_type is None:
+            os.replace(self.part_file, self.metric_file)
+        else:
+            os.remove(self.part_file)
 
 
 def collect_known_prometheus_metrics(
-    username: str, password: str, start: str, end: str, output_path: str = ""
+    username: str,
+    password: str,
+    start: str,
+    end: str,
+    output_path: str = "",
+    max_concurrency: int = 1,
+    step: str = "1m",
+    stream: bool = False,
 ):
     """
-    Collect metrics of last two weeks.
+    Collect metrics of last two weeks. Jobs of (metric, day) already collected
+    and verified in the collection manifest are skipped, so that an interrupted
+    collection can be resumed.
 
     Parameters
     ----------
@@ -21,24 +119,37 @@ def collect_known_prometheus_metrics(
         start time of the experiment in ISO8601 format
     end : str
         end time of the experiment in ISO8601 format
+    max_concurrency : int
+        maximum number of concurrent range queries, default is 1, which means
+        to collect metrics one at a time
+    step : str
+        query resolution step width in Prometheus duration string format
+    stream : bool
+        parse responses incrementally and write them series by series, so that
+        memory stays proportional to one series instead of a full response
     """
-    experiment_start = datetime.datetime.fromisoformat(start)
-    experiment_end = datetime.datetime.fromisoformat(end)
+    if max_concurrency > 1:
+        asyncio.run(
+            collect_known_prometheus_metrics_async(
+                username,
+                password,
+                start,
+                end,
+                output_path,
+                max_concurrency,
+                step,
+                stream,
+            )
+        )
+        return
     prometheus_api = PrometheusAPI(username, password)
     metric_names = pd.read_csv("prometheus_target_metrics.csv")["name"].to_list()
 
-    step = "1m"
-    metrics_dir = os.path.join(output_path, "prometheus-metrics")
-    if not os.path.exists(metrics_dir):
-        os.mkdir(metrics_dir)
-
+    metrics_dir = prepare_metrics_dir(metric_names, output_path)
     num_metric_names = len(metric_names)
-    # store map of metric names
-    metric_names_map = dict(
-        [(index + 1, metric_name) for index, metric_name in enumerate(metric_names)]
-    )
-    with open(os.path.join(metrics_dir, "metric_names_map.json"), "w") as fp:
-        json.dump(metric_names_map, fp, indent=4)
+    windows = gen_day_windows(start, end)
+    manifest = CollectionManifest.load(output_path)
+    jobs_left = gen_jobs_left(manifest, metric_names, windows)
     # collect instant metric
     # total_metric_values = 0
     # for name in metric_names:
@@ -49,17 +160,12 @@ def collect_known_prometheus_metrics(
     # print(f"total metric values: {total_metric_values}")
 
     # collect range metric
-    day_count = 1
-    start = experiment_start
-    while start < experiment_end:
-        start_timestamp = int(start.timestamp())
-        end = start + datetime.timedelta(days=1) - datetime.timedelta(seconds=1)
-        if end > experiment_end:
-            end = experiment_end
-        end_timestamp = int(end.timestamp())
-
+    for day_count, start_timestamp, end_timestamp in windows:
+        window = f"{start_timestamp}-{end_timestamp}"
         for i in range(num_metric_names):
             name = metric_names[i]
+            if (name, window) not in jobs_left:
+                continue
             # the number after metric is the index of metric name in map of metric names
             metric_file = os.path.join(
                 metrics_dir, f"metric-{i+1}-day-{day_count}.json"
@@ -67,15 +173,95 @@ def collect_known_prometheus_metrics(
             print(
                 f"collect metric {name} [{i+1}/{num_metric_names}] from day {day_count}"
             )
-            range_metric = prometheus_api.get_range_metric(
-                name, start_timestamp, end_timestamp, step
-            )
-
-            with open(metric_file, "w") as fp:
-                json.dump(range_metric, fp, separators=(",", ":"))
+            manifest.mark_started(PROMETHEUS_SOURCE, name, window)
+            if stream:
+                with RangeMetricWriter(metric_file) as writer:
+                    for item in prometheus_api.iter_range_metric(
+                        name, start_timestamp, end_timestamp, step
+                    ):
+                        writer.write(item)
+            else:
+                range_metric = prometheus_api.get_range_metric(
+                    name, start_timestamp, end_timestamp, step
+                )
+                write_range_metric(metric_file, range_metric)
+                if range_metric is None:
+                    continue
+            manifest.mark_done(PROMETHEUS_SOURCE, name, window, [metric_file])
             time.sleep(0.1)
-        start += datetime.timedelta(days=1)
-        day_count += 1
+    manifest.save()
+
+
+async def collect_known_prometheus_metrics_async(
+    username: str,
+    password: str,
+    start: str,
+    end: str,
+    output_path: str = "",
+    max_concurrency: int = 8,
+    step: str = "1m",
+    stream: bool = False,
+):
+    """
+    Collect the same metrics as `collect_known_prometheus_metrics`, but schedule
+    every (metric, day) range query concurrently over a pooled keep-alive client.
+    Each result is written to `metric-{i}-day-{d}.json` as soon as it arrives.
+
+    Parameters
+    ----------
+    max_concurrency : int
+        maximum number of range queries in flight at the same time
+    stream : bool
+        write each result series by series while its response is parsed
+    """
+    metric_names = pd.read_csv("prometheus_target_metrics.csv")["name"].to_list()
+
+    metrics_dir = prepare_metrics_dir(metric_names, output_path)
+    num_metric_names = len(metric_names)
+    windows = gen_day_windows(start, end)
+    manifest = CollectionManifest.load(output_path)
+    jobs_left = gen_jobs_left(manifest, metric_names, windows)
+    jobs = [
+        (i, day_count, start_timestamp, end_timestamp)
+        for day_count, start_timestamp, end_timestamp in windows
+        for i in range(num_metric_names)
+        if (metric_names[i], f"{start_timestamp}-{end_timestamp}") in jobs_left
+    ]
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def collect(api: AsyncPrometheusAPI, job: tuple):
+        i, day_count, start_timestamp, end_timestamp = job
+        name = metric_names[i]
+        window = f"{start_timestamp}-{end_timestamp}"
+        metric_file = os.path.join(metrics_dir, f"metric-{i+1}-day-{day_count}.json")
+        manifest.mark_started(PROMETHEUS_SOURCE, name, window)
+        if stream:
+            async with semaphore:
+                with RangeMetricWriter(metric_file) as writer:
+                    async for item in api.iter_range_metric(
+                        name, start_timestamp, end_timestamp, step
+                    ):
+                        # serialize and write off the event loop
+                        await asyncio.to_thread(writer.write, item)
+        else:
+            async with semaphore:
+                range_metric = await api.get_range_metric(
+                    name, start_timestamp, end_timestamp, step
+                )
+            await asyncio.to_thread(write_range_metric, metric_file, range_metric)
+            if range_metric is None:
+                return
+        # hash the file off the event loop
+        await asyncio.to_thread(
+            manifest.mark_done, PROMETHEUS_SOURCE, name, window, [metric_file]
+        )
+        print(
+            f"collected metric {name} [{i+1}/{num_metric_names}] from day {day_count}"
+        )
+
+    async with AsyncPrometheusAPI(username, password, max_concurrency) as api:
+        await asyncio.gather(*[collect(api, job) for job in jobs])
+    manifest.save()
 
 
 def collect_prometheus_metric_names(username: str, password: str, output_path: str):
@@ -97,13 +283,22 @@ def main():
     parser.add_argument("-p", "--password")
     parser.add_argument("-s", "--start")
     parser.add_argument("-e", "--end")
+    parser.add_argument("-c", "--concurrency", type=int, default=1)
+    parser.add_argument("--stream", action="store_true")
     args = parser.parse_args()
     # check username and password
     if not args.username:
         args.username = input("Please enter prometheus username: ")
     if not args.password:
         args.password = input("Please enter prometheus password: ")
-    collect_known_prometheus_metrics(args.username, args.password, args.start, args.end)
+    collect_known_prometheus_metrics(
+        args.username,
+        args.password,
+        args.start,
+        args.end,
+        max_concurrency=args.concurrency,
+        stream=args.stream,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,158 @@
+# keep track of collected metrics to resume interrupted collections
+from dataclasses import dataclass, field
+import datetime
+import hashlib
+import json
+import os
+import threading
+import jsonlines
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """Compute a fast content hash of a file without loading it at once."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fp:
+        while chunk := fp.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class CollectionManifest:
+    """
+    Manifest of the collection jobs of an experiment folder. Each job is a
+    (source, metric, window) triple and records its status together with the
+    byte size and content hash of every file it wrote, relative to the folder.
+
+    Updates of jobs are appended to a journal, so that each of them costs the
+    same however many jobs there are. The journal is merged into the manifest
+    when it is loaded and saved. Jobs can be updated from several threads.
+    """
+
+    MANIFEST_FNAME = "collection_manifest.json"
+    JOURNAL_FNAME = "collection_manifest.journal.jsonl"
+    STARTED = "started"
+    DONE = "done"
+    output_path: str
+    jobs: dict = field(default_factory=dict)
+    lock: threading.Lock = field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
+
+    @classmethod
+    def load(cls, output_path: str) -> "CollectionManifest":
+        manifest = cls(output_path)
+        manifest_path = os.path.join(output_path, cls.MANIFEST_FNAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as fp:
+                manifest.jobs = json.load(fp)
+        journal_path = os.path.join(output_path, cls.JOURNAL_FNAME)
+        if os.path.exists(journal_path):
+            with jsonlines.open(journal_path) as reader:
+                try:
+                    for update in reader:
+                        manifest.jobs[update["key"]] = update["job"]
+                except jsonlines.InvalidLineError:
+                    # the last update was cut off by a crash
+                    pass
+            manifest.save()
+        return manifest
+
+    def save(self):
+        """
+        Write the manifest atomically with all updates of the journal, so that
+        a crash never corrupts it, and start a new journal.
+        """
+        manifest_path = os.path.join(self.output_path, self.MANIFEST_FNAME)
+        with self.lock:
+            with open(f"{manifest_path}.part", "w") as fp:
+                json.dump(self.jobs, fp, indent=4)
+            os.replace(f"{manifest_path}.part", manifest_path)
+            journal_path = os.path.join(self.output_path, self.JOURNAL_FNAME)
+            if os.path.exists(journal_path):
+                os.remove(journal_path)
+
+    def update_job(self, key: str, job: dict):
+        """Set a job and append the update to the journal."""
+        with self.lock:
+            self.jobs[key] = job
+            with jsonlines.open(
+                os.path.join(self.output_path, self.JOURNAL_FNAME), "a"
+            ) as writer:
+                writer.write({"key": key, "job": job})
+
+    @staticmethod
+    def job_key(source: str, metric: str, window: str) -> str:
+        return f"{source}/{metric}/{window}"
+
+    def mark_started(self, source: str, metric: str, window: str):
+        self.update_job(
+            self.job_key(source, metric, window),
+            {
+                "status": CollectionManifest.STARTED,
+                "updated": datetime.datetime.now().isoformat(),
+                "files": {},
+            },
+        )
+
+    def mark_done(self, source: str, metric: str, window: str, paths: list):
+        """Record the size and hash of the files written by a finished job."""
+        files = dict()
+        for path in paths:
+            files[os.path.relpath(path, self.output_path)] = {
+                "size": os.path.getsize(path),
+                "hash": hash_file(path),
+            }
+        self.update_job(
+            self.job_key(source, metric, window),
+            {
+                "status": CollectionManifest.DONE,
+                "updated": datetime.datetime.now().isoformat(),
+                "files": files,
+            },
+        )
+
+    def get_status(self, source: str, metric: str, window: str) -> str:
+        """
+        Get the status of a job, which is "done" only if all of its files
+        still exist with the recorded size and hash, "corrupted" if any of
+        them doesn't, "started" if the job never finished and "missing" if it
+        never ran.
+        """
+        job = self.jobs.get(self.job_key(source, metric, window))
+        if job is None:
+            return "missing"
+        if job["status"] != CollectionManifest.DONE:
+            return job["status"]
+        for relpath, file_info in job["files"].items():
+            path = os.path.join(self.output_path, relpath)
+            if (
+                not os.path.exists(path)
+                or os.path.getsize(path) != file_info["size"]
+                or hash_file(path) != file_info["hash"]
+            ):
+                return "corrupted"
+        return CollectionManifest.DONE
+
+    def is_done(self, source: str, metric: str, window: str) -> bool:
+        return self.get_status(source, metric, window) == CollectionManifest.DONE
+
+    def report(self, source: str, jobs: list) -> list:
+        """
+        Print how many of the given (metric, window) jobs of a source are done
+        and return the ones left to collect.
+        """
+        jobs_left = []
+        status_counts = dict()
+        for metric, window in jobs:
+            status = self.get_status(source, metric, window)
+            status_counts[status] = status_counts.get(status, 0) + 1
+            if status != CollectionManifest.DONE:
+                jobs_left.append((metric, window))
+        summary = ", ".join(
+            f"{count} {status}" for status, count in status_counts.items()
+        )
+        print(
+            f"{source}: {len(jobs_left)}/{len(jobs)} jobs left to collect ({summary})"
+        )
+        return jobs_left
@@ -1,5 +1,12 @@
 # download metrics from google cloud monitoring
+import json
+import logging
+import os
+import threading
+import time
+
 from google.cloud.monitoring_v3 import (
+    Aggregation,
     MetricServiceClient,
     ListMetricDescriptorsRequest,
     ListMonitoredResourceDescriptorsRequest,
@@ -8,6 +15,7 @@ from google.cloud.monitoring_v3 import (
 from google.cloud.monitoring_v3.types import TimeInterval
 from google.protobuf.timestamp_pb2 import Timestamp
 from google.api.metric_pb2 import MetricDescriptor
+from google.protobuf import json_format
 
 from app.model.resource_label import ResourceLabel
 
@@ -24,11 +32,93 @@ class GCloudAPI:
         "vm_flow",
     ]
 
-    def __init__(self):
+    CACHE_TTL = 7 * 24 * 3600  # seconds before cached descriptors are fetched again
+    CACHE_SAVE_BATCH = 32  # new entries after which the cache file is saved
+
+    def __init__(self, cache_path: str = None, cache_ttl: int = CACHE_TTL):
+        """
+        Parameters
+        ----------
+        cache_path : str
+            path to a JSON file caching resource labels and metric descriptors
+            across runs, default is None, which means to cache them in memory only
+        cache_ttl : int
+            seconds after which a cached entry is fetched again
+        """
         self.client = MetricServiceClient()
         self.name = self.client.common_project_path(GCloudAPI.PROJECT_ID)
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        # reentrant, as saving the cache file may happen while it is held
+        self.cache_lock = threading.RLock()
+        self.key_locks = dict()  # (section, key) -> lock of fetching the entry
+        self.num_unsaved_entries = 0
+        self.cache = self.load_cache()
+
+    def load_cache(self) -> dict:
+        cache = {"resource_labels": {}, "metric_descriptors": {}}
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return cache
+        with open(self.cache_path) as fp:
+            cache.update(json.load(fp))
+        return cache
+
+    def save_cache(self):
+        """
+        Write new entries of the cache atomically, or skip it if its folder
+        doesn't exist. Collectors call it once they are done.
+        """
+        if self.cache_path is None:
+            return
+        cache_dir = os.path.dirname(self.cache_path)
+        if cache_dir and not os.path.exists(cache_dir):
+            logging.warning(f"Cache folder {cache_dir} doesn't exist!")
+            return
+        with self.cache_lock:
+            if self.num_unsaved_entries == 0:
+                return
+            with open(f"{self.cache_path}.part", "w") as fp:
+                json.dump(self.cache, fp)
+            os.replace(f"{self.cache_path}.part", self.cache_path)
+            self.num_unsaved_entries = 0
+
+    def is_fresh(self, entry: dict) -> bool:
+        return entry is not None and time.time() - entry["updated"] <= self.cache_ttl
+
+    def get_cached(self, section: str, key: str, fetch):
+        """
+        Get an entry of a cache section, calling `fetch` to get it from the
+        API if it is missing or expired. Each entry is fetched under its own
+        lock, so that threads sharing this instance fetch it only once, while
+        other entries are read or fetched concurrently. The cache file is saved
+        every `CACHE_SAVE_BATCH` new entries and by `save_cache`.
+        """
+        with self.cache_lock:
+            entry = self.cache[section].get(key)
+            if self.is_fresh(entry):
+                return entry["value"]
+            key_lock = self.key_locks.setdefault((section, key), threading.Lock())
+        with key_lock:
+            # another thread may have fetched it meanwhile
+            with self.cache_lock:
+                entry = self.cache[section].get(key)
+            if not self.is_fresh(entry):
+                entry = {"updated": time.time(), "value": fetch()}
+                with self.cache_lock:
+                    self.cache[section][key] = entry
+                    self.num_unsaved_entries += 1
+                    if self.num_unsaved_entries >= self.CACHE_SAVE_BATCH:
+                        self.save_cache()
+        return entry["value"]
 
     def get_resource_labels(self, resource_type: str) -> list:
+        return self.get_cached(
+            "resource_labels",
+            resource_type,
+            lambda: self.fetch_resource_labels(resource_type),
+        )
+
+    def fetch_resource_labels(self, resource_type: str) -> list:
         resource_labels = []
         resource_descriptors_request = ListMonitoredResourceDescriptorsRequest(
             name=self.name, filter=f'resource.type = "{resource_type}"'
@@ -45,7 +135,12 @@ class GCloudAPI:
         return resource_labels
 
     def get_time_series(
-        self, metric_type: str, start: str, end: str, namespace: str = None
+        self,
+        metric_type: str,
+        start: str,
+        end: str,
+        namespace: str = None,
+        aggregation: Aggregation = None,
     ):
         """
         Get time series data of a specific metric type.
@@ -60,6 +155,9 @@ class GCloudAPI:
             end time in ISO8601 format
         namespace : str
             the namespace of the target services, default is None, which means to consider all namespaces
+        aggregation : Aggregation
+            alignment and reduction performed by Cloud Monitoring before returning
+            the time series, default is None, which means to get raw points
         """
         start_time = Timestamp()
         start_time.FromJsonString(start)
@@ -74,31 +172,46 @@ class GCloudAPI:
             filter=metric_filter,
             interval=TimeInterval(start_time=start_time, end_time=end_time),
             view=ListTimeSeriesRequest.TimeSeriesView.FULL,
+            aggregation=aggregation,
         )
         time_series_page_result = self.client.list_time_series(
             request=time_series_request
         )
         return time_series_page_result
 
-    def get_metric_descriptors(self, metric_type_prefix: str):
-        metric_descriptors_request = ListMetricDescriptorsRequest(
-            name=self.name,
-            filter=f'metric.type = starts_with("{metric_type_prefix}")',
+    def get_metric_descriptors(self, metric_type_prefix: str) -> list:
+        return self.list_metric_descriptors(
+            f'metric.type = starts_with("{metric_type_prefix}")'
         )
-        metric_descriptors_page_result = self.client.list_metric_descriptors(
-            request=metric_descriptors_request
+
+    def get_metric_descriptors_by_name(self, metric_type: str) -> list:
+        return self.list_metric_descriptors(f'metric.type = "{metric_type}"')
+
+    def list_metric_descriptors(self, metric_filter: str) -> list:
+        """Get cached metric descriptors matching a filter."""
+        descriptors = self.get_cached(
+            "metric_descriptors",
+            metric_filter,
+            lambda: self.fetch_metric_descriptors(metric_filter),
         )
-        return metric_descriptors_page_result
+        return [
+            json_format.ParseDict(descriptor, MetricDescriptor())
+            for descriptor in descriptors
+        ]
 
-    def get_metric_descriptors_by_name(self, metric_type: str):
+    def fetch_metric_descriptors(self, metric_filter: str) -> list:
+        """Get metric descriptors matching a filter as JSON serializable dicts."""
         metric_descriptors_request = ListMetricDescriptorsRequest(
             name=self.name,
-            filter=f'metric.type = "{metric_type}"',
+            filter=metric_filter,
         )
         metric_descriptors_page_result = self.client.list_metric_descriptors(
             request=metric_descriptors_request
         )
-        return metric_descriptors_page_result
+        return [
+            json_format.MessageToDict(metric_desc)
+            for metric_desc in metric_descriptors_page_result
+        ]
 
     @staticmethod
     def gen_all_metric_type_prefixes() -> list:
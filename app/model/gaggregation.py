@@ -0,0 +1,64 @@
+# server-side aggregation of time series in google cloud monitoring
+from dataclasses import dataclass, field
+from google.cloud.monitoring_v3 import Aggregation
+from google.protobuf.duration_pb2 import Duration
+from app.model.metric_kind import MetricKind
+from app.model.value_type import ValueType
+
+
+@dataclass
+class GAggregation:
+    """
+    Aggregation spec of a time series request. Each series is aligned to
+    `alignment_period` seconds with `per_series_aligner`, then series are
+    combined with `cross_series_reducer` within groups of the same
+    `group_by_fields`, e.g. "resource.label.pod_name".
+
+    If `per_series_aligner` is None, it is chosen from the metric kind and
+    value type of each metric type. Aligned points of GAUGE and DELTA numbers
+    and of booleans are the means within each period, which is what
+    `GCloudAgg.aggregate_by_minute` computes from raw points. No aligner gives
+    that for the others:
+
+    - CUMULATIVE numbers are kept cumulative with ALIGN_NEXT_OLDER, which
+      takes the latest point of each period instead of the mean of its points.
+    - GAUGE distributions also take the latest point with ALIGN_NEXT_OLDER.
+    - CUMULATIVE and DELTA distributions are aligned with ALIGN_DELTA. Each
+      aligned point is then the distribution of all values within the period,
+      so its count, mean and deviation are not the means of those of raw
+      points. Its bucket counts match the raw path, which sums bucket counts
+      within minutes after `GMetric` converts cumulative ones to counts
+      between points.
+    """
+
+    alignment_period: int = 60
+    per_series_aligner: str = None
+    cross_series_reducer: str = "REDUCE_NONE"
+    group_by_fields: list = field(default_factory=list)
+
+    @staticmethod
+    def get_default_aligner(metric_kind: int, value_type: int) -> str:
+        if value_type == ValueType.DISTRIBUTION.value:
+            if metric_kind == MetricKind.GAUGE.value:
+                return "ALIGN_NEXT_OLDER"
+            return "ALIGN_DELTA"
+        if value_type == ValueType.BOOL.value:
+            return "ALIGN_FRACTION_TRUE"
+        if metric_kind == MetricKind.CUMULATIVE.value:
+            # counters are kept cumulative as in raw points
+            return "ALIGN_NEXT_OLDER"
+        return "ALIGN_MEAN"
+
+    def to_aggregation(self, metric_desc) -> Aggregation:
+        """Build the aggregation of a request for the given metric descriptor."""
+        per_series_aligner = self.per_series_aligner
+        if per_series_aligner is None:
+            per_series_aligner = GAggregation.get_default_aligner(
+                metric_desc.metric_kind, metric_desc.value_type
+            )
+        return Aggregation(
+            alignment_period=Duration(seconds=self.alignment_period),
+            per_series_aligner=Aggregation.Aligner[per_series_aligner],
+            cross_series_reducer=Aggregation.Reducer[self.cross_series_reducer],
+            group_by_fields=self.group_by_fields,
+        )
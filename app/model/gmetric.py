@@ -2,9 +2,13 @@
 from dataclasses import dataclass
 import logging
 import os
+import numpy as np
 import pandas as pd
+import proto
 import csv
+import json
 import jsonlines
+from app.model.metric_kind import MetricKind
 from app.model.value_type import ValueType
 
 
@@ -13,59 +17,182 @@ class GMetric:
     METRICS_DIR_NAME = "gcloud_metrics"
     METRIC_TYPE_MAP_FNAME = "metric_type_map.csv"  # stores index -> metric type
     KPI_MAP_FNAME = "kpi_map.jsonl"  # each KPI is a unique combination of labels for a specifc metric type
+    # value type -> (field of the typed value, dtype of the value column)
+    VALUE_FIELDS = {
+        ValueType.DOUBLE.value: ("double_value", np.float64),
+        ValueType.INT64.value: ("int64_value", np.int64),
+        ValueType.BOOL.value: ("bool_value", np.int64),
+    }
+    BUCKET_BOUNDS_FNAME = "bucket_bounds.json"  # bucket bounds of distributions
     mtype: str
     labels: dict
     df_points: pd.DataFrame
+    # distributions only, counts of (point, bucket) within the interval of each
+    # point and bounds of finite buckets
+    bucket_counts: np.ndarray = None
+    bucket_bounds: np.ndarray = None
 
     @classmethod
     def from_time_series(cls, time_series) -> "GMetric":
+        # read the underlying protobuf message, as proto-plus wraps every field access
+        if isinstance(time_series, proto.Message):
+            time_series = type(time_series).pb(time_series)
         mtype = time_series.metric.type
         labels = (
             dict(time_series.resource.labels)
             | dict(time_series.metric.labels)
             | {"resource_type": time_series.resource.type}
         )
-        df_points = None
-        if time_series.value_type == ValueType.DOUBLE.value:
-            points = [
-                (int(point.interval.end_time.timestamp()), point.value.double_value)
-                for point in time_series.points
-            ]
-            df_points = pd.DataFrame(points, columns=["timestamp", "value"])
-        elif time_series.value_type == ValueType.INT64.value:
-            points = [
-                (int(point.interval.end_time.timestamp()), point.value.int64_value)
-                for point in time_series.points
-            ]
-            df_points = pd.DataFrame(points, columns=["timestamp", "value"])
-        elif time_series.value_type == ValueType.DISTRIBUTION.value:
-            points = [
-                (
-                    int(point.interval.end_time.timestamp()),
-                    point.value.distribution_value.count,
-                    point.value.distribution_value.mean,
-                    point.value.distribution_value.sum_of_squared_deviation,
-                )
-                for point in time_series.points
-            ]
-            df_points = pd.DataFrame(
-                points,
-                columns=["timestamp", "count", "mean", "sum_of_squared_deviation"],
+        if time_series.value_type == ValueType.DISTRIBUTION.value:
+            df_points, bucket_counts, bucket_bounds = GMetric.distribution_points_to_df(
+                time_series.points, time_series.metric_kind
             )
-        elif time_series.value_type == ValueType.BOOL.value:
-            points = [
-                (int(point.interval.end_time.timestamp()), 1)
-                if point.value.bool_value
-                else (int(point.interval.end_time.timestamp()), 0)
-                for point in time_series.points
-            ]
-            df_points = pd.DataFrame(points, columns=["timestamp", "value"])
-        else:
+            return GMetric(mtype, labels, df_points, bucket_counts, bucket_bounds)
+        df_points = GMetric.points_to_df(time_series.points, time_series.value_type)
+        if df_points is None:
             logging.warning(
                 f"Unsupported type {time_series.value_type} for time series of metric {mtype}!"
             )
         return GMetric(mtype, labels, df_points)
 
+    @staticmethod
+    def points_to_df(points, value_type: int) -> pd.DataFrame:
+        """
+        Convert protobuf points to a dataframe in a single pass over the points,
+        which fills preallocated arrays of timestamps in seconds and values.
+        Return None if the value type is not supported.
+        """
+        if value_type not in GMetric.VALUE_FIELDS:
+            return None
+        value_field, dtype = GMetric.VALUE_FIELDS[value_type]
+        num_points = len(points)
+        timestamps = np.empty(num_points, dtype=np.int64)
+        values = np.empty(num_points, dtype=dtype)
+        for i, point in enumerate(points):
+            timestamps[i] = point.interval.end_time.seconds
+            values[i] = getattr(point.value, value_field)
+        return pd.DataFrame({"timestamp": timestamps, "value": values}, copy=False)
+
+    @staticmethod
+    def distribution_points_to_df(
+        points, metric_kind: int = MetricKind.GAUGE.value
+    ) -> tuple:
+        """
+        Convert protobuf distribution points in a single pass like `points_to_df`.
+        Besides the dataframe of count, mean and sum of squared deviation, return
+        the bucket counts as a 2-D array of (point, bucket) and the bounds of the
+        buckets, both None if the distributions have no bucket options. Bucket
+        counts are also None if the bucket options of points differ, since their
+        buckets could not be merged. Bucket counts of CUMULATIVE distributions
+        are converted to counts within the interval of each point, see
+        `cumulative_to_delta`.
+        """
+        num_points = len(points)
+        timestamps = np.empty(num_points, dtype=np.int64)
+        start_times = np.empty(num_points, dtype=np.int64)
+        counts = np.empty(num_points, dtype=np.int64)
+        means = np.empty(num_points, dtype=np.float64)
+        ssds = np.empty(num_points, dtype=np.float64)
+        bucket_options = None
+        bucket_bounds = None
+        bucket_counts = None
+        is_consistent = True
+        for i, point in enumerate(points):
+            timestamps[i] = point.interval.end_time.seconds
+            start_times[i] = point.interval.start_time.seconds
+            distribution = point.value.distribution_value
+            counts[i] = distribution.count
+            means[i] = distribution.mean
+            ssds[i] = distribution.sum_of_squared_deviation
+            # trailing empty buckets are omitted in responses
+            point_bucket_counts = distribution.bucket_counts
+            if not is_consistent or len(point_bucket_counts) == 0:
+                continue
+            if bucket_options is None:
+                bucket_options = distribution.bucket_options
+                bucket_bounds = GMetric.get_bucket_bounds(bucket_options)
+                if bucket_bounds is not None:
+                    # underflow, finite and overflow buckets
+                    bucket_counts = np.zeros(
+                        (num_points, len(bucket_bounds) + 1), dtype=np.int64
+                    )
+            if (
+                bucket_counts is None
+                or distribution.bucket_options != bucket_options
+                or len(point_bucket_counts) > bucket_counts.shape[1]
+            ):
+                is_consistent = False
+                continue
+            bucket_counts[i, : len(point_bucket_counts)] = point_bucket_counts
+        if not is_consistent:
+            logging.warning(
+                "Buckets of distribution points don't match, bucket counts are dropped!"
+            )
+            bucket_counts = None
+            bucket_bounds = None
+        elif bucket_counts is not None and metric_kind == MetricKind.CUMULATIVE.value:
+            bucket_counts = GMetric.cumulative_to_delta(
+                timestamps, start_times, bucket_counts
+            )
+        df_points = pd.DataFrame(
+            {
+                "timestamp": timestamps,
+                "count": counts,
+                "mean": means,
+                "sum_of_squared_deviation": ssds,
+            },
+            copy=False,
+        )
+        return df_points, bucket_counts, bucket_bounds
+
+    @staticmethod
+    def cumulative_to_delta(
+        timestamps: np.ndarray, start_times: np.ndarray, bucket_counts: np.ndarray
+    ) -> np.ndarray:
+        """
+        Convert cumulative bucket counts of points to counts within the
+        interval since the previous point in time, so that counts of points can
+        be summed. Counts restart at a new start time or where any bucket
+        decreases. The first point gets no counts, as counts before it are
+        unknown.
+        """
+        order = np.argsort(timestamps, kind="stable")
+        cumulative_counts = bucket_counts[order]
+        delta_counts = np.zeros_like(cumulative_counts)
+        delta_counts[1:] = cumulative_counts[1:] - cumulative_counts[:-1]
+        is_reset = np.zeros(len(order), dtype=bool)
+        is_reset[1:] = (start_times[order][1:] != start_times[order][:-1]) | (
+            delta_counts[1:] < 0
+        ).any(axis=1)
+        delta_counts[is_reset] = cumulative_counts[is_reset]
+        delta_counts[:1] = 0
+        # back in the order of points
+        bucket_counts = np.empty_like(delta_counts)
+        bucket_counts[order] = delta_counts
+        return bucket_counts
+
+    @staticmethod
+    def get_bucket_bounds(bucket_options) -> np.ndarray:
+        """
+        Get the bounds of the finite buckets of distribution bucket options, or
+        None if they are not specified.
+        """
+        options = bucket_options.WhichOneof("options")
+        if options == "linear_buckets":
+            linear = bucket_options.linear_buckets
+            return linear.offset + linear.width * np.arange(
+                linear.num_finite_buckets + 1, dtype=np.float64
+            )
+        elif options == "exponential_buckets":
+            exponential = bucket_options.exponential_buckets
+            return exponential.scale * np.power(
+                exponential.growth_factor,
+                np.arange(exponential.num_finite_buckets + 1, dtype=np.float64),
+            )
+        elif options == "explicit_buckets":
+            return np.array(bucket_options.explicit_buckets.bounds, dtype=np.float64)
+        return None
+
     @staticmethod
     def write_metric_type(
         output_path: str, metric_type_index: int, metric_name: str, metric_kind: str
@@ -111,6 +238,26 @@ class GMetric:
         kpi_path = os.path.join(kpi_dir, f"kpi-{kpi_index}.csv")
         if self.df_points is not None and not self.df_points.empty:
             self.df_points.to_csv(kpi_path, index=False)
+            if self.bucket_counts is not None:
+                # bounds are stored once for all KPIs of a metric type
+                bucket_bounds_path = os.path.join(kpi_dir, GMetric.BUCKET_BOUNDS_FNAME)
+                if not os.path.exists(bucket_bounds_path):
+                    with open(bucket_bounds_path, "w") as fp:
+                        json.dump(self.bucket_bounds.tolist(), fp)
+                else:
+                    with open(bucket_bounds_path) as fp:
+                        bucket_bounds = np.array(json.load(fp))
+                    if not np.array_equal(bucket_bounds, self.bucket_bounds):
+                        logging.warning(
+                            f"Bucket bounds of KPI {kpi_index} of metric {self.mtype} "
+                            + "differ from other KPIs, bucket counts are dropped!"
+                        )
+                        return
+                # rows of bucket counts match rows of the KPI time series
+                np.save(
+                    os.path.join(kpi_dir, f"kpi-{kpi_index}-buckets.npy"),
+                    self.bucket_counts,
+                )
 
     @staticmethod
     def metric_type_exists(output_path: str, metric_type: str) -> bool:
@@ -126,3 +273,30 @@ class GMetric:
                     if row["name"] == metric_type:
                         return True
         return False
+
+    @staticmethod
+    def read_metric_types(output_path: str) -> set:
+        """Read the names of all metric types stored in the metric type map."""
+        metric_type_map_path = os.path.join(
+            output_path, GMetric.METRICS_DIR_NAME, GMetric.METRIC_TYPE_MAP_FNAME
+        )
+        if not os.path.exists(metric_type_map_path):
+            return set()
+        with open(metric_type_map_path, newline="") as csvfile:
+            return {row["name"] for row in csv.DictReader(csvfile)}
+
+    @staticmethod
+    def get_kpi_dir(output_path: str, metric_type_index: int) -> str:
+        return os.path.join(
+            output_path, GMetric.METRICS_DIR_NAME, f"metric-type-{metric_type_index}"
+        )
+
+    @staticmethod
+    def list_kpi_files(output_path: str, metric_type_index: int) -> list:
+        """List paths of all files written for KPIs of a metric type."""
+        kpi_dir = GMetric.get_kpi_dir(output_path, metric_type_index)
+        if not os.path.exists(kpi_dir):
+            return []
+        return [
+            os.path.join(kpi_dir, filename) for filename in sorted(os.listdir(kpi_dir))
+        ]
@@ -0,0 +1,224 @@
+# columnar storage of all KPIs of a metric type from google cloud monitoring
+from functools import lru_cache
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from app.model.gmetric import GMetric
+
+
+class GMetricStore:
+    """
+    Store all KPIs of a metric type in one Parquet file instead of one CSV file
+    per KPI. Points are kept in a long table of (kpi_id, kpi, timestamp,
+    value...) rows, where kpi holds the JSON string of the KPI labels as a
+    dictionary-encoded column, so the label table is stored once per KPI.
+    Points are buffered and written in row groups of about `buffer_size` rows.
+    Bucket counts of distributions are kept in a nullable list column, which
+    every store has, and their bounds once in the metadata of the file.
+    """
+
+    STORE_FNAME = "metric-type-{metric_type_index}.parquet"
+    BUFFER_SIZE = 1_000_000
+    KEY_COLUMNS = ["kpi_id", "kpi", "timestamp"]
+    BUCKET_COUNTS_COLUMN = "bucket_counts"
+    BUCKET_BOUNDS_KEY = b"bucket_bounds"
+
+    def __init__(
+        self, output_path: str, metric_type_index: int, buffer_size: int = BUFFER_SIZE
+    ):
+        self.path = GMetricStore.get_store_path(output_path, metric_type_index)
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.num_buffered_points = 0
+        self.schema = None
+        self.writer = None
+        self.bucket_bounds = None
+
+    def __enter__(self) -> "GMetricStore":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def get_store_path(output_path: str, metric_type_index: int) -> str:
+        return os.path.join(
+            output_path,
+            GMetric.METRICS_DIR_NAME,
+            GMetricStore.STORE_FNAME.format(metric_type_index=metric_type_index),
+        )
+
+    def write_kpi(self, gmetric: GMetric, kpi_index: int):
+        """Buffer the points of a KPI, KPIs without points are not stored."""
+        if gmetric.df_points is None or gmetric.df_points.empty:
+            return
+        df_points = gmetric.df_points.assign(
+            kpi_id=kpi_index, kpi=json.dumps(gmetric.labels, sort_keys=True)
+        )
+        if gmetric.bucket_counts is not None:
+            if self.bucket_bounds is None:
+                self.bucket_bounds = gmetric.bucket_bounds
+            if np.array_equal(gmetric.bucket_bounds, self.bucket_bounds):
+                df_points[GMetricStore.BUCKET_COUNTS_COLUMN] = list(
+                    gmetric.bucket_counts
+                )
+            else:
+                logging.warning(
+                    f"Bucket bounds of KPI {kpi_index} of metric {gmetric.mtype} "
+                    + "differ from other KPIs, bucket counts are dropped!"
+                )
+                df_points[GMetricStore.BUCKET_COUNTS_COLUMN] = None
+        self.buffer.append(df_points)
+        self.num_buffered_points += len(df_points)
+        if self.num_buffered_points >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        df = pd.concat(self.buffer, ignore_index=True)
+        self.buffer = []
+        self.num_buffered_points = 0
+        if self.BUCKET_COUNTS_COLUMN not in df:
+            df[self.BUCKET_COUNTS_COLUMN] = None
+        if self.schema is None:
+            value_columns = [
+                col
+                for col in df.columns
+                if col not in self.KEY_COLUMNS and col != self.BUCKET_COUNTS_COLUMN
+            ]
+            # bucket counts are declared for every store, so that bucket
+            # counts of KPIs after the first flush are kept
+            self.schema = pa.schema(
+                [
+                    ("kpi_id", pa.int32()),
+                    ("kpi", pa.dictionary(pa.int32(), pa.string())),
+                    ("timestamp", pa.int64()),
+                ]
+                + [(col, pa.from_numpy_dtype(df[col].dtype)) for col in value_columns]
+                + [(self.BUCKET_COUNTS_COLUMN, pa.list_(pa.int64()))]
+            )
+            metrics_dir = os.path.dirname(self.path)
+            if metrics_dir and not os.path.exists(metrics_dir):
+                os.mkdir(metrics_dir)
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        elif set(df.columns) != set(self.schema.names):
+            raise ValueError(
+                f"Columns {df.columns.to_list()} of KPIs don't match the columns "
+                + f"{self.schema.names} of {self.path}!"
+            )
+        table = pa.Table.from_pandas(
+            df[self.schema.names], schema=self.schema, preserve_index=False
+        )
+        self.writer.write_table(table)
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            if self.bucket_bounds is not None:
+                # bounds are only known once a KPI with bucket counts is written
+                self.writer.add_key_value_metadata(
+                    {self.BUCKET_BOUNDS_KEY: json.dumps(self.bucket_bounds.tolist())}
+                )
+            self.writer.close()
+            self.writer = None
+
+    @staticmethod
+    def find_store(metrics_path: str, metric_type_index: int) -> str:
+        """
+        Get the path of the store of a metric type in a directory of collected
+        metrics, or None if the metric type is not stored in columnar format.
+        """
+        store_path = os.path.join(
+            metrics_path,
+            GMetricStore.STORE_FNAME.format(metric_type_index=metric_type_index),
+        )
+        return store_path if os.path.exists(store_path) else None
+
+    @staticmethod
+    def read_kpi_map(store_path: str) -> list:
+        """Read the KPI map in the format of the lines of `GMetric.KPI_MAP_FNAME`."""
+        df_kpis = (
+            pq.read_table(store_path, columns=["kpi_id", "kpi"])
+            .to_pandas()
+            .drop_duplicates("kpi_id")
+        )
+        return [
+            {"index": int(kpi_id), "kpi": json.loads(kpi)}
+            for kpi_id, kpi in zip(df_kpis["kpi_id"], df_kpis["kpi"])
+        ]
+
+    @staticmethod
+    def read_points(store_path: str) -> pd.DataFrame:
+        """Read the long table of points of all KPIs without their labels."""
+        schema = pq.read_schema(store_path)
+        columns = [
+            col
+            for col in schema.names
+            if col not in ["kpi", GMetricStore.BUCKET_COUNTS_COLUMN]
+        ]
+        return pq.read_table(store_path, columns=columns).to_pandas()
+
+    @staticmethod
+    @lru_cache(maxsize=2)
+    def read_kpis_of_version(store_path: str, mtime: int) -> dict:
+        df_points = GMetricStore.read_points(store_path)
+        return {
+            int(kpi_id): df_kpi.drop(columns="kpi_id").reset_index(drop=True)
+            for kpi_id, df_kpi in df_points.groupby("kpi_id", sort=False)
+        }
+
+    @staticmethod
+    def read_kpis(store_path: str) -> dict:
+        """
+        Read points of all KPIs as a dict of KPI index -> dataframe with the
+        same columns as the CSV file of a KPI. The last stores read are cached
+        as long as they are unchanged, as KPIs of the same metric type are
+        usually read one after another.
+        """
+        return GMetricStore.read_kpis_of_version(
+            store_path, os.stat(store_path).st_mtime_ns
+        )
+
+    @staticmethod
+    def read_bucket_bounds(store_path: str) -> np.ndarray:
+        """Read bucket bounds of distributions, or None if they are not stored."""
+        metadata = pq.read_metadata(store_path).metadata or {}
+        if GMetricStore.BUCKET_BOUNDS_KEY not in metadata:
+            return None
+        return np.array(json.loads(metadata[GMetricStore.BUCKET_BOUNDS_KEY]))
+
+    @staticmethod
+    def read_buckets(store_path: str) -> dict:
+        """
+        Read bucket counts of distributions as a dict of KPI index ->
+        (timestamps, 2-D array of bucket counts of each point).
+        """
+        table = pq.read_table(
+            store_path,
+            columns=["kpi_id", "timestamp", GMetricStore.BUCKET_COUNTS_COLUMN],
+        )
+        kpi_ids = table.column("kpi_id").to_numpy()
+        timestamps = table.column("timestamp").to_numpy()
+        bucket_counts = table.column(GMetricStore.BUCKET_COUNTS_COLUMN).combine_chunks()
+        num_buckets = len(GMetricStore.read_bucket_bounds(store_path)) + 1
+        # KPIs without bucket counts are null
+        is_valid = bucket_counts.is_valid().to_numpy(zero_copy_only=False)
+        bucket_counts = bucket_counts.flatten().to_numpy().reshape(-1, num_buckets)
+        # group points by KPI, which keeps the order of points of each KPI
+        order = np.argsort(kpi_ids[is_valid], kind="stable")
+        kpi_ids, first_positions = np.unique(
+            kpi_ids[is_valid][order], return_index=True
+        )
+        return {
+            int(kpi_id): (kpi_timestamps, kpi_bucket_counts)
+            for kpi_id, kpi_timestamps, kpi_bucket_counts in zip(
+                kpi_ids,
+                np.split(timestamps[is_valid][order], first_positions[1:]),
+                np.split(bucket_counts[order], first_positions[1:]),
+            )
+        }
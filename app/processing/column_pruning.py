@@ -0,0 +1,97 @@
+# drop constant, empty and duplicate columns of merged time series
+import json
+import numpy as np
+import pandas as pd
+
+CHUNK_SIZE = 4096  # rows hashed at once
+HASH_SEED = 0
+
+
+def hash_columns(values: np.ndarray, positions: np.ndarray = None) -> np.ndarray:
+    """
+    Hash each column of a 2-D array, or the columns at `positions`, into 64
+    bits. Element hashes are combined with a random odd weight per row, so
+    that the hash depends on the order of values. Rows are hashed in chunks
+    to bound memory, and columns are selected within each chunk, so that the
+    array is never copied whole.
+    """
+    if positions is None:
+        positions = np.arange(values.shape[1])
+    num_rows, num_cols = len(values), len(positions)
+    weights = np.random.default_rng(HASH_SEED).integers(
+        0, np.iinfo(np.uint64).max, num_rows, dtype=np.uint64, endpoint=True
+    )
+    weights |= np.uint64(1)
+    hashes = np.zeros(num_cols, dtype=np.uint64)
+    for start in range(0, num_rows, CHUNK_SIZE):
+        chunk = values[start : start + CHUNK_SIZE, positions]
+        element_hashes = pd.util.hash_array(chunk.ravel()).reshape(chunk.shape)
+        # uint64 arithmetic wraps around
+        hashes += (element_hashes * weights[start : start + CHUNK_SIZE, None]).sum(
+            axis=0, dtype=np.uint64
+        )
+    return hashes
+
+
+def find_pruned_columns(df: pd.DataFrame) -> dict:
+    """
+    Find columns of numeric time series that carry no information.
+
+    Returns
+    -------
+    a dict of
+        "empty": columns with only NaN,
+        "zero": columns with only 0,
+        "constant": column -> value of other columns with a single value,
+        "duplicate": column -> first column with identical values
+    """
+    values = df.to_numpy(dtype=np.float64)
+    columns = df.columns
+    # NaN in a column makes its min and max NaN, so such columns are not constant
+    mins = values.min(axis=0, initial=np.inf)
+    maxs = values.max(axis=0, initial=-np.inf)
+    is_empty = np.isnan(values).all(axis=0)
+    is_constant = (mins == maxs) & ~is_empty
+    is_zero = is_constant & (mins == 0)
+    pruned = {
+        "empty": columns[is_empty].to_list(),
+        "zero": columns[is_zero].to_list(),
+        "constant": {
+            col: float(value)
+            for col, value in zip(
+                columns[is_constant & ~is_zero], mins[is_constant & ~is_zero]
+            )
+        },
+        "duplicate": dict(),
+    }
+    # compare columns with the same hash to rule out collisions
+    positions = np.flatnonzero(~is_empty & ~is_constant)
+    hashes = hash_columns(values, positions)
+    kept_positions = dict()  # hash -> positions of kept columns
+    for position, column_hash in zip(positions, hashes):
+        candidates = kept_positions.setdefault(column_hash, [])
+        for kept_position in candidates:
+            if np.array_equal(
+                values[:, position], values[:, kept_position], equal_nan=True
+            ):
+                pruned["duplicate"][columns[position]] = columns[kept_position]
+                break
+        else:
+            candidates.append(position)
+    return pruned
+
+
+def prune_columns(df: pd.DataFrame, manifest_path: str) -> pd.DataFrame:
+    """
+    Drop empty, zero, constant and duplicate columns of a dataframe and write
+    what was dropped to a JSON manifest, see `find_pruned_columns`.
+    """
+    pruned = find_pruned_columns(df)
+    with open(manifest_path, "w") as fp:
+        json.dump(pruned, fp, indent=4)
+    dropped_columns = [col for columns in pruned.values() for col in columns]
+    print(
+        f"Prune {len(dropped_columns)}/{len(df.columns)} columns: "
+        + ", ".join(f"{len(columns)} {kind}" for kind, columns in pruned.items())
+    )
+    return df.drop(columns=dropped_columns)
@@ -1,4 +1,6 @@
+import contextlib
 import os
+import numpy as np
 import pandas as pd
 from app.collect_metrics import FAILURE_INJECTION_PATH
 from app.processing.gcloud.data_aggregate import GCloudAgg
@@ -8,9 +10,17 @@ from app.processing.gcloud.data_preprocess import (
 )
 from app.processing.prometheus.data_aggregate import aggregate_directly
 from app.processing.prometheus.data_merge import merge_individual_metric
+from app.processing.matrix_io import (
+    CHUNK_SIZE,
+    TimeSeriesWriter,
+    compact_df,
+    get_output_formats,
+    iter_aligned_chunks,
+    read_matrix_dtypes,
+)
 
 
-def merge_faulty_metrics():
+def merge_faulty_metrics(max_workers: int = 1, storage_format: str = "csv"):
     df = pd.read_csv(
         os.path.join(FAILURE_INJECTION_PATH, "alemira_failure_injection_log.csv")
     )
@@ -24,33 +34,85 @@ def merge_faulty_metrics():
         )
         gcloud_agg.aggregate_by_minute()
         gcloud_agg.perform_aggregation_for_all_metrics()
-        remove_constants_and_merge(exp_path)
+        remove_constants_and_merge(exp_path, storage_format)
         merge_output_path = os.path.join(exp_path, "prometheus_merged")
         aggregate_output_path = os.path.join(exp_path, "prometheus_aggregated")
         aggregate_directly(
             os.path.join(exp_path, "prometheus-metrics"),
             aggregate_output_path,
+            max_workers,
+        )
+        merge_individual_metric(
+            merge_output_path, aggregate_output_path, storage_format
         )
-        merge_individual_metric(merge_output_path, aggregate_output_path)
-        merge_complete_metrics(exp_path, merge_output_path)
+        merge_complete_metrics(exp_path, merge_output_path, storage_format)
+
 
+def read_csv_columns(path: str) -> list:
+    """Read the columns of `{path}.csv` written by `write_time_series`."""
+    return pd.read_csv(f"{path}.csv", index_col="timestamp", nrows=0).columns.to_list()
 
-def merge_complete_metrics(metric_path, merge_output_path):
+
+def merge_complete_metrics(
+    metric_path, merge_output_path, storage_format="csv", chunk_size=CHUNK_SIZE
+):
+    """
+    Join Locust, GCloud and Prometheus time series on the timestamps of
+    Locust, filling missing values with 0. GCloud and Prometheus series are
+    read and joined in chunks of `chunk_size` timestamps, which are appended
+    to the output, so that the complete time series are never held in memory.
+    The output is written in every format of `get_output_formats`.
+    """
     df_locust = pd.read_csv(
         os.path.join(metric_path, "locust_cleaned_agg_stats.csv")
     ).set_index("timestamp")
-    df_gcloud = (
-        pd.read_csv(os.path.join(metric_path, "gcloud-complete-time-series.csv"))
-        .set_index("timestamp")
-        .add_prefix("gc-")
+    # align timestamps whether they are read as strings or datetimes
+    df_locust.index = pd.to_datetime(df_locust.index)
+    if not df_locust.index.is_monotonic_increasing:
+        df_locust = df_locust.sort_index()
+    gcloud_path = os.path.join(metric_path, "gcloud-complete-time-series")
+    prometheus_path = os.path.join(merge_output_path, "prom-complete-time-series")
+    if storage_format == "parquet":
+        gcloud_dtypes = read_matrix_dtypes(f"{gcloud_path}.parquet")
+        prometheus_dtypes = read_matrix_dtypes(f"{prometheus_path}.parquet")
+    else:
+        # columns of CSV files are kept in float64 in Parquet
+        gcloud_dtypes = dict.fromkeys(read_csv_columns(gcloud_path), np.float64)
+        prometheus_dtypes = dict.fromkeys(read_csv_columns(prometheus_path), np.float64)
+    dtypes = {
+        **compact_df(df_locust).dtypes.to_dict(),
+        **{f"gc-{col}": dtype for col, dtype in gcloud_dtypes.items()},
+        **prometheus_dtypes,
+    }
+    locust_chunks = [
+        df_locust.iloc[start : start + chunk_size]
+        for start in range(0, len(df_locust), chunk_size)
+    ]
+    timestamp_chunks = [df_chunk.index for df_chunk in locust_chunks]
+    gcloud_chunks = iter_aligned_chunks(gcloud_path, storage_format, timestamp_chunks)
+    prometheus_chunks = iter_aligned_chunks(
+        prometheus_path, storage_format, timestamp_chunks
     )
-    df_prometheus = pd.read_csv(
-        os.path.join(merge_output_path, "prom-complete-time-series.csv")
-    ).set_index("timestamp")
-    df = pd.concat([df_locust, df_gcloud, df_prometheus], axis=1)
-    df = df.loc[df_locust.index]
-    df.fillna(0, inplace=True)
-    df.to_csv(os.path.join(metric_path, "complete-time-series.csv"))
+    with contextlib.ExitStack() as stack:
+        writers = [
+            stack.enter_context(
+                TimeSeriesWriter(
+                    os.path.join(metric_path, "complete-time-series"),
+                    output_format,
+                    dtypes,
+                )
+            )
+            for output_format in get_output_formats(storage_format)
+        ]
+        for df_locust_chunk, df_gcloud, df_prometheus in zip(
+            locust_chunks, gcloud_chunks, prometheus_chunks
+        ):
+            df = pd.concat(
+                [df_locust_chunk, df_gcloud.add_prefix("gc-"), df_prometheus], axis=1
+            )
+            df.fillna(0, inplace=True)
+            for writer in writers:
+                writer.write(df)
 
 
 def main():
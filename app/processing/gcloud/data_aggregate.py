@@ -1,17 +1,31 @@
+import numpy as np
 import pandas as pd
 import os
 import json
 from dataclasses import dataclass
+from app.processing.stats import aggregate_rows
+from app.processing.time_buckets import df_by_minute
+from app.processing.gcloud.histogram import (
+    HISTOGRAMS_FNAME,
+    QUANTILES,
+    get_quantile_name,
+    histogram_quantiles,
+    merge_histograms,
+    read_histograms,
+)
 
 
 @dataclass
 class GCloudAgg:
     NUM_KPI_MAPS_THRESHOLD = 16  # based on metric type 1
+    AGG_FUNCS = ["min", "max", "mean", "median", "std", "sum"]
+    AGG_QUANTILES = [0.5, 0.75, 0.8, 0.9, 0.99]
     gcloud_combined_path: str
     gcloud_round_time_path: str
     agg_output_path: str
 
     def get_metric_indices(self) -> list:
+        """Get indices of metrics with a KPI map in the combined path."""
         return [
             filename.lstrip("metric-").rstrip("-kpi-map.json")
             for filename in os.listdir(self.gcloud_combined_path)
@@ -46,6 +60,72 @@ class GCloudAgg:
             )
             return pd.read_csv(metric_path)
 
+    def get_histograms(self, metric_index: int) -> dict:
+        """
+        Get bucket counts of a distribution metric per KPI and minute, or None
+        if they are not collected, see `histogram.write_histograms`.
+        """
+        histograms_path = os.path.join(
+            self.gcloud_combined_path,
+            HISTOGRAMS_FNAME.format(metric_index=metric_index),
+        )
+        if not os.path.exists(histograms_path):
+            return None
+        return read_histograms(histograms_path)
+
+    def gen_df_quantiles(
+        self, metric_index: int, groups: dict, timestamps: pd.Index
+    ) -> pd.DataFrame:
+        """
+        Compute quantiles of distributions of each group of KPIs per minute
+        by merging their histograms, in one pass over all groups.
+
+        Parameters
+        ----------
+        metric_index : int
+            index of the metric
+        groups : dict
+            new KPI index -> list of indices of the KPIs to merge
+        timestamps : pd.Index
+            timestamps of the aggregated metric to align the quantiles with
+
+        Returns
+        -------
+        a dataframe with one `agg-kpi-{index}-p{quantile}` column per quantile
+        of each group, or None if bucket counts are not collected
+        """
+        histograms = self.get_histograms(metric_index)
+        if histograms is None or not groups:
+            return None
+        kpi_positions = {
+            kpi_index: position
+            for position, kpi_index in enumerate(histograms["kpi_indices"])
+        }
+        group_positions = [
+            [
+                kpi_positions[kpi_index]
+                for kpi_index in kpi_indices
+                if kpi_index in kpi_positions
+            ]
+            for kpi_indices in groups.values()
+        ]
+        # (group, minute, quantile)
+        quantiles = histogram_quantiles(
+            merge_histograms(histograms["histograms"], group_positions),
+            histograms["bucket_bounds"],
+        )
+        num_minutes = len(histograms["minutes"])
+        df_quantiles = pd.DataFrame(
+            quantiles.transpose(1, 0, 2).reshape(num_minutes, -1),
+            index=pd.to_datetime(histograms["minutes"], unit="s"),
+            columns=[
+                f"agg-kpi-{new_kpi_index}-{get_quantile_name(quantile)}"
+                for new_kpi_index in groups
+                for quantile in QUANTILES
+            ],
+        )
+        return df_quantiles.reindex(pd.to_datetime(timestamps)).set_axis(timestamps)
+
     @staticmethod
     def index_list(series) -> list:
         return series.to_list()
@@ -154,28 +234,9 @@ class GCloudAgg:
 
     @staticmethod
     def gen_df_metric_agg(df_metric_to_agg: pd.DataFrame) -> pd.DataFrame:
-        min_series = df_metric_to_agg.min(axis=1).rename("min")
-        max_series = df_metric_to_agg.max(axis=1).rename("max")
-        mean_series = df_metric_to_agg.mean(axis=1).rename("mean")
-        median_series = df_metric_to_agg.median(axis=1).rename("median")
-        std_series = df_metric_to_agg.std(axis=1).rename("std")
-        sum_series = df_metric_to_agg.sum(axis=1).rename("sum")
-        quantile_series = df_metric_to_agg.quantile(
-            [0.5, 0.75, 0.8, 0.9, 0.99], axis=1
-        ).transpose()
-        df_metric_agg = pd.concat(
-            [
-                min_series,
-                max_series,
-                mean_series,
-                median_series,
-                std_series,
-                sum_series,
-                quantile_series,
-            ],
-            axis=1,
+        return aggregate_rows(
+            df_metric_to_agg, GCloudAgg.AGG_FUNCS + GCloudAgg.AGG_QUANTILES
         )
-        return df_metric_agg
 
     def aggregate_normal(
         self,
@@ -233,6 +294,39 @@ class GCloudAgg:
                 os.path.join(self.agg_output_path, f"metric-{metric_index}.csv")
             )
 
+    @staticmethod
+    def pool_distributions(
+        counts: np.ndarray, means: np.ndarray, ssds: np.ndarray
+    ) -> tuple:
+        """
+        Merge distributions of several KPIs into one exact pooled distribution
+        per timestamp with the parallel variance formula. Each argument is a
+        2-D array of (timestamp, KPI), where NaN means a KPI has no point.
+
+        Returns
+        -------
+        a tuple of 1-D arrays of the pooled count, mean and sum of squared
+        deviation, which are NaN at timestamps without any point
+        """
+        has_point = ~np.isnan(counts)
+        counts = np.where(has_point, counts, 0)
+        pooled_count = counts.sum(axis=1)
+        weighted_sums = np.where(has_point, counts * means, 0).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # distributions without samples have a mean of 0
+            pooled_mean = np.where(pooled_count > 0, weighted_sums / pooled_count, 0)
+        deviations = np.where(
+            has_point,
+            ssds + counts * (means - pooled_mean[:, None]) ** 2,
+            0,
+        )
+        pooled_ssd = deviations.sum(axis=1)
+        is_empty = ~has_point.any(axis=1)
+        pooled_count = np.where(is_empty, np.nan, pooled_count)
+        pooled_mean = np.where(is_empty, np.nan, pooled_mean)
+        pooled_ssd = np.where(is_empty, np.nan, pooled_ssd)
+        return pooled_count, pooled_mean, pooled_ssd
+
     def aggregate_distribution(
         self,
         df_kpi_map_unique: pd.DataFrame,
@@ -242,6 +336,7 @@ class GCloudAgg:
         new_kpi_map_list = []
         new_kpi_map_index = 1
         df_agg_list = []
+        groups = dict()  # new KPI index -> indices of KPIs to merge
         for row in df_kpi_map_unique.itertuples():
             # generate new KPI
             kpi_keys = df_kpi_map_unique.index.names
@@ -261,6 +356,8 @@ class GCloudAgg:
                 f"kpi-{i}-sum_of_squared_deviation" for i in valid_indices
             ]
 
+            if len(columns_count_to_merge) > 0:
+                groups[new_kpi_map_index] = valid_indices
             if len(columns_count_to_merge) == 1:
                 new_kpi_map_list.append(new_kpi_map)
                 single_column_name = [
@@ -286,29 +383,26 @@ class GCloudAgg:
             elif len(columns_count_to_merge) == 0:
                 continue
             new_kpi_map_list.append(new_kpi_map)
-            # merge more than 1 columns
-            df_metric_count_to_agg = df_metric[columns_count_to_merge]
-            df_metric_count_agg = (
-                GCloudAgg.gen_df_metric_agg(df_metric_count_to_agg)
-                .add_prefix(f"agg-kpi-{new_kpi_map_index}-")
-                .add_suffix("-count")
+            # merge more than 1 columns into one pooled distribution
+            count, mean, ssd = GCloudAgg.pool_distributions(
+                df_metric[columns_count_to_merge].to_numpy(dtype=float),
+                df_metric[columns_mean_to_merge].to_numpy(dtype=float),
+                df_metric[columns_sd_to_merge].to_numpy(dtype=float),
             )
-            df_agg_list.append(df_metric_count_agg)
-            df_metric_mean_to_agg = df_metric[columns_mean_to_merge]
-            df_metric_mean_agg = (
-                GCloudAgg.gen_df_metric_agg(df_metric_mean_to_agg)
-                .add_prefix(f"agg-kpi-{new_kpi_map_index}-")
-                .add_suffix("-mean")
-            )
-            df_agg_list.append(df_metric_mean_agg)
-            df_metric_sd_to_agg = df_metric[columns_sd_to_merge]
-            df_metric_sd_agg = (
-                GCloudAgg.gen_df_metric_agg(df_metric_sd_to_agg)
-                .add_prefix(f"agg-kpi-{new_kpi_map_index}-")
-                .add_suffix("-sd")
+            df_agg_list.append(
+                pd.DataFrame(
+                    {
+                        f"agg-kpi-{new_kpi_map_index}-count": count,
+                        f"agg-kpi-{new_kpi_map_index}-mean": mean,
+                        f"agg-kpi-{new_kpi_map_index}-sd": ssd,
+                    },
+                    index=df_metric.index,
+                )
             )
-            df_agg_list.append(df_metric_sd_agg)
             new_kpi_map_index += 1
+        df_quantiles = self.gen_df_quantiles(metric_index, groups, df_metric.index)
+        if df_quantiles is not None:
+            df_agg_list.append(df_quantiles)
         df_complete_agg = pd.concat(df_agg_list, axis=1)
         if not df_complete_agg.empty:
             with open(
@@ -366,14 +460,7 @@ class GCloudAgg:
             os.mkdir(self.gcloud_round_time_path)
         for metric_index in self.get_metric_indices():
             print(f"Processing metric {metric_index} ...")
-            df_metric = self.get_df_metric(metric_index)
-            df_metric["timestamp"] = pd.to_datetime(
-                df_metric["timestamp"], unit="s"
-            ).dt.round("min")
-            if len(df_metric["timestamp"]) != len(
-                df_metric["timestamp"].drop_duplicates()
-            ):
-                df_metric = df_metric.groupby("timestamp").agg("mean")
+            df_metric = df_by_minute(self.get_df_metric(metric_index))
             df_metric.reset_index().to_csv(
                 os.path.join(self.gcloud_round_time_path, f"metric-{metric_index}.csv"),
                 index=False,
@@ -1,5 +1,7 @@
 import os
 import pandas as pd
+from app.processing.column_pruning import prune_columns
+from app.processing.matrix_io import get_output_formats, write_time_series
 
 
 def get_metric_indices(gcloud_aggregated_path: str) -> list:
@@ -14,7 +16,7 @@ def is_constant_df(df: pd.DataFrame) -> bool:
     return ((df == df.iloc[0]).all()).all()
 
 
-def remove_constants_and_merge(gcloud_metrics_path: str):
+def remove_constants_and_merge(gcloud_metrics_path: str, storage_format: str = "csv"):
     gcloud_aggregated_path = os.path.join(gcloud_metrics_path, "gcloud_aggregated")
     df_all_list = []
     for metric_index in get_metric_indices(gcloud_aggregated_path):
@@ -27,7 +29,17 @@ def remove_constants_and_merge(gcloud_metrics_path: str):
         else:
             df_all_list.append(df_metric.add_prefix(f"metric-{metric_index}-"))
     df_all = pd.concat(df_all_list, axis=1)
-    df_all.to_csv(os.path.join(gcloud_metrics_path, "gcloud-complete-time-series.csv"))
+    df_all.index = pd.to_datetime(df_all.index)
+    df_all = prune_columns(
+        df_all,
+        os.path.join(gcloud_metrics_path, "gcloud-complete-time-series-pruned.json"),
+    )
+    for output_format in get_output_formats(storage_format):
+        write_time_series(
+            df_all,
+            os.path.join(gcloud_metrics_path, "gcloud-complete-time-series"),
+            output_format,
+        )
 
 
 def inspect_merged_df(gcloud_metrics_path: str):
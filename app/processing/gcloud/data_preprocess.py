@@ -2,7 +2,17 @@ import json
 import os
 import jsonlines
 
+import numpy as np
 import pandas as pd
+from app.model.gmetric import GMetric
+from app.model.gmetric_store import GMetricStore
+from app.processing.gcloud.histogram import (
+    HISTOGRAMS_FNAME,
+    gen_minute_histograms,
+    write_histograms,
+)
+from app.processing.kpi_registry import KpiRegistry
+from app.processing.time_buckets import df_by_minute
 
 
 def has_same_metric_type():
@@ -42,76 +52,232 @@ def remove_duplicated_gcloud_metric_maps():
             os.remove(metric_type_map_path)
 
 
+def read_kpi_map_list(metrics_path: str, metric_type_index: int) -> list:
+    """Read the KPI map of a metric type stored either in CSV or columnar format."""
+    store_path = GMetricStore.find_store(metrics_path, metric_type_index)
+    if store_path is not None:
+        return GMetricStore.read_kpi_map(store_path)
+    kpi_map_path = os.path.join(
+        metrics_path, f"metric-type-{metric_type_index}", "kpi_map.jsonl"
+    )
+    with jsonlines.open(kpi_map_path) as reader:
+        return [obj for obj in reader]
+
+
+def read_kpi(metrics_path: str, metric_type_index: int, kpi_index: int):
+    """Read the time series of a KPI stored either in CSV or columnar format."""
+    store_path = GMetricStore.find_store(metrics_path, metric_type_index)
+    if store_path is not None:
+        df_kpi = GMetricStore.read_kpis(store_path).get(int(kpi_index))
+        if df_kpi is None:
+            # KPIs without points are not stored
+            return pd.DataFrame(columns=["timestamp"])
+        return df_kpi.copy()
+    kpi_path = os.path.join(
+        metrics_path, f"metric-type-{metric_type_index}", f"kpi-{kpi_index}.csv"
+    )
+    return pd.read_csv(kpi_path)
+
+
+def read_buckets(metrics_path: str, metric_type_index: int) -> tuple:
+    """
+    Read bucket counts of a distribution metric type stored either in CSV or
+    columnar format. Return the bucket bounds and a dict of KPI index ->
+    (timestamps, 2-D array of bucket counts of each point), or (None, {}) if
+    the metric type has no bucket counts.
+    """
+    store_path = GMetricStore.find_store(metrics_path, metric_type_index)
+    if store_path is not None:
+        bucket_bounds = GMetricStore.read_bucket_bounds(store_path)
+        if bucket_bounds is None:
+            return None, {}
+        return bucket_bounds, GMetricStore.read_buckets(store_path)
+    kpi_dir = os.path.join(metrics_path, f"metric-type-{metric_type_index}")
+    bucket_bounds_path = os.path.join(kpi_dir, GMetric.BUCKET_BOUNDS_FNAME)
+    if not os.path.exists(bucket_bounds_path):
+        return None, {}
+    with open(bucket_bounds_path) as fp:
+        bucket_bounds = np.array(json.load(fp))
+    kpi_buckets = dict()
+    for kpi_map in read_kpi_map_list(metrics_path, metric_type_index):
+        kpi_index = kpi_map["index"]
+        buckets_path = os.path.join(kpi_dir, f"kpi-{kpi_index}-buckets.npy")
+        if os.path.exists(buckets_path):
+            timestamps = read_kpi(metrics_path, metric_type_index, kpi_index)[
+                "timestamp"
+            ].to_numpy()
+            kpi_buckets[kpi_index] = (timestamps, np.load(buckets_path))
+    return bucket_bounds, kpi_buckets
+
+
 def gen_unique_kpi_maps(folders: list, metric_type_index: int) -> list:
     """
     Generate a list of unique KPI maps for each metric type in the format of
     {"index": <unique-int>, "gcloud_metrics-day-1": <kpi-index>, "gcloud_metrics-day-2": <kpi-index>, ..., "kpi": {...}}
     """
-    unique_kpi_index = 1
-    unique_kpi_json_map = dict()  # dict of json strings of kpi maps
+    registry = KpiRegistry()
+    unique_kpi_maps = []
     for folder in folders:
-        kpi_map_path = os.path.join(
-            "gcloud-metrics",
-            folder,
-            f"metric-type-{metric_type_index}",
-            "kpi_map.jsonl",
+        kpi_map = read_kpi_map_list(
+            os.path.join("gcloud-metrics", folder), metric_type_index
         )
-        with jsonlines.open(kpi_map_path) as reader:
-            kpi_map = [obj for obj in reader]
         for kpi_map_item in kpi_map:
-            unique_kpi_json = json.dumps(kpi_map_item["kpi"], sort_keys=True)
-            if unique_kpi_json in unique_kpi_json_map:
-                unique_kpi_json_map[unique_kpi_json][folder] = kpi_map_item["index"]
+            unique_kpi_index = registry.register(kpi_map_item["kpi"])
+            if unique_kpi_index <= len(unique_kpi_maps):
+                unique_kpi_maps[unique_kpi_index - 1][folder] = kpi_map_item["index"]
             else:
-                unique_kpi_json_map[unique_kpi_json] = {
-                    "index": unique_kpi_index,
-                    folder: kpi_map_item["index"],
-                    "kpi": kpi_map_item["kpi"],
-                }
-                unique_kpi_index += 1
-    return list(unique_kpi_json_map.values())
+                unique_kpi_maps.append(
+                    {
+                        "index": unique_kpi_index,
+                        folder: kpi_map_item["index"],
+                        "kpi": registry.get_labels(unique_kpi_index),
+                    }
+                )
+    return unique_kpi_maps
 
 
 def merge_time_series_across_days(
     unique_kpi_maps: list, metric_type_index: int
 ) -> pd.DataFrame:
-    """Merge time series for each metric type and write to a csv file."""
-    all_records = []
+    """
+    Merge time series of each KPI across days into a wide dataframe with a
+    timestamp column and `kpi-{index}-{column}` columns. Values of the same
+    timestamp are summed and missing values count as 0. The values of each
+    KPI are aligned on the sorted timestamps of all KPIs and copied into the
+    preallocated result, releasing the points read for the KPI, so that memory
+    peaks at about the points read plus the result.
+    """
+    folders = list(
+        dict.fromkeys(
+            key
+            for kpi_map in unique_kpi_maps
+            for key in kpi_map
+            if key.startswith("gcloud_metrics-day")
+        )
+    )
+    # dataframes of each KPI, read folder by folder so that KPIs of the same
+    # columnar store are read one after another
+    combined_kpis = [[] for _ in unique_kpi_maps]
+    for folder in folders:
+        for position, kpi_map in enumerate(unique_kpi_maps):
+            if folder in kpi_map:
+                combined_kpis[position].append(
+                    read_kpi(
+                        os.path.join("gcloud-metrics", folder),
+                        metric_type_index,
+                        kpi_map[folder],
+                    )
+                )
+    # columns of each KPI, KPIs without points are useless
+    kpi_columns = []
     useless_kpi_maps = []
-    for kpi_map in unique_kpi_maps:
-        # get folders that share the same KPI
-        folders = [key for key in kpi_map if key.startswith("gcloud_metrics-day")]
-        combined_kpi = []  # list of dataframes of a single KPI
-        for folder in folders:
-            kpi_index = kpi_map[folder]
-            kpi_path = os.path.join(
-                "gcloud-metrics",
-                folder,
-                f"metric-type-{metric_type_index}",
-                f"kpi-{kpi_index}.csv",
+    for kpi_map, combined_kpi in zip(unique_kpi_maps, combined_kpis):
+        if all(df_kpi.empty for df_kpi in combined_kpi):
+            useless_kpi_maps.append(kpi_map)
+            kpi_columns.append([])
+            continue
+        kpi_columns.append(
+            list(
+                dict.fromkeys(
+                    col
+                    for df_kpi in combined_kpi
+                    for col in df_kpi.columns
+                    if col != "timestamp"
+                )
             )
-            combined_kpi.append(pd.read_csv(kpi_path))
+        )
+    if len(useless_kpi_maps) == len(unique_kpi_maps):
+        unique_kpi_maps.clear()
+        return pd.DataFrame()
+    timestamps = np.unique(
+        np.concatenate(
+            [
+                df_kpi["timestamp"].to_numpy(dtype=np.int64)
+                for combined_kpi in combined_kpis
+                for df_kpi in combined_kpi
+                if not df_kpi.empty
+            ]
+        )
+    )
+    columns = [
+        f"kpi-{kpi_map['index']}-{col}"
+        for kpi_map, value_columns in zip(unique_kpi_maps, kpi_columns)
+        for col in value_columns
+    ]
+    # fill the result in place and release the dataframes of each KPI once
+    # they are copied, so that they are not held along with the whole result
+    values = np.zeros((len(timestamps), len(columns)), dtype=np.float64)
+    first_column = 0
+    for position, value_columns in enumerate(kpi_columns):
+        if not value_columns:
+            continue
         # merge time series of the same KPI
-        combined_kpi_df = pd.concat(combined_kpi, ignore_index=True)
-        if not combined_kpi_df.empty:
-            kpi_map_index = kpi_map["index"]
-            combined_kpi_df = (
-                combined_kpi_df.set_index("timestamp")
-                .add_prefix(f"kpi-{kpi_map_index}-")
-                .reset_index()
-            )
-            all_records += combined_kpi_df.to_dict("records")
+        combined_kpi_df = pd.concat(combined_kpis[position], ignore_index=True)
+        combined_kpis[position] = None
+        rows = np.searchsorted(
+            timestamps, combined_kpi_df["timestamp"].to_numpy(dtype=np.int64)
+        )
+        kpi_values = combined_kpi_df[value_columns].to_numpy(dtype=np.float64)
+        del combined_kpi_df
+        block = values[:, first_column : first_column + len(value_columns)]
+        kpi_values = np.where(np.isnan(kpi_values), 0, kpi_values)
+        if len(np.unique(rows)) == len(rows):
+            block[rows] = kpi_values
         else:
-            useless_kpi_maps.append(kpi_map)
+            # sum values of duplicate timestamps
+            np.add.at(block, rows, kpi_values)
+        first_column += len(value_columns)
     # clean KPI map
     for kpi_map in useless_kpi_maps:
         unique_kpi_maps.remove(kpi_map)
+    all_df = pd.DataFrame(values, columns=columns, copy=False)
+    all_df.insert(0, "timestamp", timestamps)
+    return all_df
 
-    all_df = pd.DataFrame(all_records)
-    if not all_df.empty:
-        all_df = all_df.groupby("timestamp").sum().reset_index()
 
-    return all_df
+def merge_buckets_across_days(unique_kpi_maps: list, metric_type_index: int) -> tuple:
+    """
+    Merge bucket counts of each unique KPI across days. Return the bucket
+    bounds and a dict of unique KPI index -> (timestamps, 2-D array of bucket
+    counts of each point), or (None, {}) if no day has bucket counts or the
+    bucket bounds differ between days.
+    """
+    merged_bounds = None
+    day_buckets = dict()  # folder -> KPI index -> (timestamps, bucket counts)
+    for kpi_map in unique_kpi_maps:
+        for folder in kpi_map:
+            if not folder.startswith("gcloud_metrics-day") or folder in day_buckets:
+                continue
+            bucket_bounds, kpi_buckets = read_buckets(
+                os.path.join("gcloud-metrics", folder), metric_type_index
+            )
+            day_buckets[folder] = kpi_buckets
+            if bucket_bounds is None:
+                continue
+            if merged_bounds is None:
+                merged_bounds = bucket_bounds
+            elif not np.array_equal(merged_bounds, bucket_bounds):
+                print(
+                    f"Bucket bounds of metric {metric_type_index} differ across "
+                    + "days, bucket counts are dropped!"
+                )
+                return None, {}
+    if merged_bounds is None:
+        return None, {}
+    merged_buckets = dict()
+    for kpi_map in unique_kpi_maps:
+        kpi_buckets = [
+            day_buckets[folder][kpi_index]
+            for folder, kpi_index in kpi_map.items()
+            if folder.startswith("gcloud_metrics-day")
+            and kpi_index in day_buckets[folder]
+        ]
+        if kpi_buckets:
+            merged_buckets[kpi_map["index"]] = (
+                np.concatenate([timestamps for timestamps, _ in kpi_buckets]),
+                np.concatenate([bucket_counts for _, bucket_counts in kpi_buckets]),
+            )
+    return merged_bounds, merged_buckets
 
 
 def merge_time_series_in_one_metric(
@@ -120,27 +286,21 @@ def merge_time_series_in_one_metric(
     kpi_list = []
     for kpi_map in kpi_map_list:
         kpi_index = kpi_map["index"]
-        kpi_path = os.path.join(
-            metrics_path,
-            f"metric-type-{metric_type_index}",
-            f"kpi-{kpi_index}.csv",
-        )
-        df_kpi = pd.read_csv(kpi_path)
-        df_kpi["timestamp"] = pd.to_datetime(df_kpi["timestamp"], unit="s").dt.round(
-            "min"
-        )
-        df_kpi = df_kpi.set_index("timestamp").add_prefix(f"kpi-{kpi_index}-")
+        df_kpi = read_kpi(metrics_path, metric_type_index, kpi_index)
+        # points of each KPI are averaged within minutes before joining
+        df_kpi = df_by_minute(df_kpi).add_prefix(f"kpi-{kpi_index}-")
         kpi_list.append(df_kpi)
-    df_kpis = pd.concat(kpi_list, axis=1)
-    if len(df_kpis.index) != len(df_kpis.index.drop_duplicates()):
-        df_kpis = df_kpis.groupby("timestamp").agg("mean")
-    return df_kpis
+    return pd.concat(kpi_list, axis=1, sort=True)
 
 
 def metric_type_exists(folders: list, metric_type_index: int) -> bool:
     for folder in folders:
-        if not os.path.exists(
-            os.path.join("gcloud-metrics", folder, f"metric-type-{metric_type_index}")
+        metrics_path = os.path.join("gcloud-metrics", folder)
+        if (
+            not os.path.exists(
+                os.path.join(metrics_path, f"metric-type-{metric_type_index}")
+            )
+            and GMetricStore.find_store(metrics_path, metric_type_index) is None
         ):
             return False
     return True
@@ -174,6 +334,10 @@ def merge_normal_gcloud_kpis_for_same_metric():
         unique_kpi_maps = gen_unique_kpi_maps(folders, metric_type_index)
         # merge time series
         merged_df = merge_time_series_across_days(unique_kpi_maps, metric_type_index)
+        # keep bucket counts of distributions per minute for their quantiles
+        bucket_bounds, kpi_buckets = merge_buckets_across_days(
+            unique_kpi_maps, metric_type_index
+        )
         # remove useless keys in KPI maps
         for kpi_map in unique_kpi_maps:
             useless_keys = [
@@ -190,26 +354,21 @@ def merge_normal_gcloud_kpis_for_same_metric():
                 "w",
             ) as fp:
                 json.dump(unique_kpi_maps, fp)
+            if kpi_buckets:
+                write_histograms(
+                    os.path.join(
+                        merge_destination,
+                        HISTOGRAMS_FNAME.format(metric_index=metric_type_index),
+                    ),
+                    *gen_minute_histograms(kpi_buckets),
+                    bucket_bounds,
+                )
             merged_df.to_csv(
                 os.path.join(merge_destination, f"metric-{metric_type_index}.csv"),
                 index=False,
             )
 
 
-def copy_kpi_map_to_destination(
-    folder: str, metrics_path: str, merge_destination: str
-) -> list:
-    kpi_map_path = os.path.join(
-        metrics_path,
-        folder,
-        "kpi_map.jsonl",
-    )
-    with jsonlines.open(kpi_map_path) as reader:
-        kpi_map_list = [obj for obj in reader]
-
-    return kpi_map_list
-
-
 def merge_faulty_gcloud_kpis_for_same_metric(metrics_parent_path: str):
     metrics_path = os.path.join(metrics_parent_path, "gcloud_metrics")
     merge_destination = os.path.join(metrics_parent_path, "gcloud_combined")
@@ -221,10 +380,8 @@ def merge_faulty_gcloud_kpis_for_same_metric(metrics_parent_path: str):
         if folder.startswith("metric-type")
     ]
     for folder in metric_folders:
-        metric_type_index = folder.lstrip("metric-type-")
-        kpi_map_list = copy_kpi_map_to_destination(
-            folder, metrics_path, merge_destination
-        )
+        metric_type_index = folder.lstrip("metric-type-").removesuffix(".parquet")
+        kpi_map_list = read_kpi_map_list(metrics_path, metric_type_index)
         df_kpis = merge_time_series_in_one_metric(
             kpi_map_list, metric_type_index, metrics_path
         )
@@ -235,6 +392,17 @@ def merge_faulty_gcloud_kpis_for_same_metric(metrics_parent_path: str):
             "w",
         ) as fp:
             json.dump(kpi_map_list, fp)
+        # keep bucket counts of distributions per minute for their quantiles
+        bucket_bounds, kpi_buckets = read_buckets(metrics_path, metric_type_index)
+        if kpi_buckets:
+            write_histograms(
+                os.path.join(
+                    merge_destination,
+                    HISTOGRAMS_FNAME.format(metric_index=metric_type_index),
+                ),
+                *gen_minute_histograms(kpi_buckets),
+                bucket_bounds,
+            )
         df_kpis.to_csv(
             os.path.join(merge_destination, f"metric-{metric_type_index}.csv"),
             index=False,
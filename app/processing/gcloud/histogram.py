@@ -0,0 +1,135 @@
+# merge bucket counts of distributions and compute their quantiles
+import numpy as np
+from app.processing.time_buckets import round_to_minutes
+
+QUANTILES = [0.5, 0.9, 0.99]
+HISTOGRAMS_FNAME = "metric-{metric_index}-buckets.npz"
+
+
+def get_quantile_name(quantile: float) -> str:
+    return f"p{round(quantile * 100)}"
+
+
+def gen_minute_histograms(kpi_buckets: dict) -> tuple:
+    """
+    Sum bucket counts of each KPI within minutes. Bucket counts of points must
+    be counts within the interval of each point, as `GMetric` keeps them for
+    DELTA and CUMULATIVE distributions alike, see `GMetric.cumulative_to_delta`.
+
+    Parameters
+    ----------
+    kpi_buckets : dict
+        KPI index -> (timestamps in seconds, 2-D array of bucket counts of each point)
+
+    Returns
+    -------
+    a tuple of sorted KPI indices, minutes in seconds and a 3-D array of
+    bucket counts of (KPI, minute, bucket)
+    """
+    kpi_indices = np.array(sorted(kpi_buckets), dtype=np.int64)
+    kpi_minutes = [
+        round_to_minutes(kpi_buckets[kpi_index][0]) for kpi_index in kpi_indices
+    ]
+    minutes = np.unique(np.concatenate(kpi_minutes))
+    bucket_counts = np.concatenate(
+        [kpi_buckets[kpi_index][1] for kpi_index in kpi_indices]
+    )
+    rows = np.repeat(
+        np.arange(len(kpi_indices)), [len(points) for points in kpi_minutes]
+    )
+    cols = np.searchsorted(minutes, np.concatenate(kpi_minutes))
+    histograms = np.zeros(
+        (len(kpi_indices), len(minutes), bucket_counts.shape[1]), dtype=np.int64
+    )
+    np.add.at(histograms, (rows, cols), bucket_counts)
+    return kpi_indices, minutes, histograms
+
+
+def merge_histograms(histograms: np.ndarray, groups: list) -> np.ndarray:
+    """
+    Merge histograms of groups of KPIs exactly by summing their bucket counts.
+
+    Parameters
+    ----------
+    histograms : np.ndarray
+        3-D array of bucket counts of (KPI, minute, bucket)
+    groups : list
+        lists of row positions in `histograms` of KPIs in each group
+
+    Returns
+    -------
+    3-D array of bucket counts of (group, minute, bucket)
+    """
+    membership = np.zeros((len(groups), len(histograms)), dtype=np.int64)
+    for group_position, rows in enumerate(groups):
+        membership[group_position, rows] = 1
+    return np.tensordot(membership, histograms, axes=1)
+
+
+def histogram_quantiles(
+    histograms: np.ndarray, bucket_bounds: np.ndarray, quantiles: list = QUANTILES
+) -> np.ndarray:
+    """
+    Estimate quantiles of histograms by linear interpolation within the
+    bucket holding each quantile. Quantiles in the underflow or overflow
+    bucket are clamped to the lowest or highest bound. Empty histograms give NaN.
+
+    Parameters
+    ----------
+    histograms : np.ndarray
+        array of bucket counts with buckets in the last axis, which are the
+        underflow bucket, the finite buckets and the overflow bucket
+    bucket_bounds : np.ndarray
+        bounds of the finite buckets
+    quantiles : list
+        quantiles to estimate
+
+    Returns
+    -------
+    array of quantiles with the same shape as `histograms` except the last
+    axis, which holds the quantiles
+    """
+    cumulative_counts = np.cumsum(histograms, axis=-1)
+    ranks = cumulative_counts[..., -1:] * np.asarray(quantiles)
+    # index of the first bucket whose cumulative count reaches each rank
+    bucket_indices = np.sum(cumulative_counts[..., None, :] < ranks[..., None], axis=-1)
+    bucket_indices = np.minimum(bucket_indices, histograms.shape[-1] - 1)
+    counts_below = np.where(
+        bucket_indices > 0,
+        np.take_along_axis(cumulative_counts, np.maximum(bucket_indices - 1, 0), -1),
+        0,
+    )
+    counts_in_bucket = np.take_along_axis(histograms, bucket_indices, -1)
+    # underflow and overflow buckets have the same lower and upper bound
+    bounds = np.concatenate([bucket_bounds[:1], bucket_bounds, bucket_bounds[-1:]])
+    lower_bounds = bounds[bucket_indices]
+    upper_bounds = bounds[bucket_indices + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fractions = np.where(
+            counts_in_bucket > 0, (ranks - counts_below) / counts_in_bucket, 0
+        )
+    return np.where(
+        ranks > 0, lower_bounds + (upper_bounds - lower_bounds) * fractions, np.nan
+    )
+
+
+def write_histograms(
+    histograms_path: str,
+    kpi_indices: np.ndarray,
+    minutes: np.ndarray,
+    histograms: np.ndarray,
+    bucket_bounds: np.ndarray,
+):
+    np.savez_compressed(
+        histograms_path,
+        kpi_indices=kpi_indices,
+        minutes=minutes,
+        histograms=histograms,
+        bucket_bounds=bucket_bounds,
+    )
+
+
+def read_histograms(histograms_path: str) -> dict:
+    """Read histograms written by `write_histograms` as a dict of arrays."""
+    with np.load(histograms_path) as npz:
+        return {key: npz[key] for key in npz.files}
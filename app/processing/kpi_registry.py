@@ -0,0 +1,58 @@
+# identify KPIs of a metric by their labels across experiments
+import hashlib
+import json
+import sys
+
+
+class KpiRegistry:
+    """
+    Registry of the unique KPIs of a metric, where a KPI is a unique set of
+    labels. Each label set is identified by a stable 64-bit fingerprint and
+    gets an index in order of registration starting from 1, so that lookups
+    and inserts take constant time. Label strings are interned, as the same
+    labels repeat in KPIs of all experiments.
+    """
+
+    def __init__(self):
+        self.indices = dict()  # fingerprint -> index of KPI
+        self.kpis = []  # labels of each KPI in order of index
+
+    def __len__(self) -> int:
+        return len(self.kpis)
+
+    @staticmethod
+    def fingerprint(labels: dict) -> int:
+        """Hash the labels into 64 bits regardless of their order."""
+        digest = hashlib.blake2b(
+            json.dumps(labels, sort_keys=True, separators=(",", ":")).encode(),
+            digest_size=8,
+        ).digest()
+        return int.from_bytes(digest, "little")
+
+    @staticmethod
+    def intern_labels(labels: dict) -> dict:
+        return {
+            sys.intern(key): sys.intern(value) if isinstance(value, str) else value
+            for key, value in labels.items()
+        }
+
+    def lookup(self, labels: dict) -> int:
+        """Get the index of a KPI, or None if it is not registered."""
+        return self.indices.get(KpiRegistry.fingerprint(labels))
+
+    def register(self, labels: dict) -> int:
+        """Get the index of a KPI, registering it first if it is new."""
+        fingerprint = KpiRegistry.fingerprint(labels)
+        index = self.indices.get(fingerprint)
+        if index is None:
+            self.kpis.append(KpiRegistry.intern_labels(labels))
+            index = len(self.kpis)
+            self.indices[fingerprint] = index
+        elif self.kpis[index - 1] != labels:
+            raise ValueError(
+                f"Fingerprint collision of {labels} and {self.kpis[index - 1]}!"
+            )
+        return index
+
+    def get_labels(self, index: int) -> dict:
+        return self.kpis[index - 1]
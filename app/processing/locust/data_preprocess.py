@@ -2,6 +2,7 @@ import os
 from scipy.stats import zscore
 import numpy as np
 import pandas as pd
+from app.processing.time_buckets import round_to_minutes, to_datetime_index
 
 METRIC_PATH = "/Users/ketai/Library/CloudStorage/OneDrive-USI/Thesis/experiments/normal"
 
@@ -9,8 +10,8 @@ METRIC_PATH = "/Users/ketai/Library/CloudStorage/OneDrive-USI/Thesis/experiments
 def agg_stats_to_minute(stats_path: str) -> pd.DataFrame:
     df_stats = pd.read_csv(stats_path)
     df_stats = df_stats[df_stats["Name"] == "Aggregated"].drop(columns=["Type", "Name"])
-    df_stats["Timestamp"] = pd.to_datetime(df_stats["Timestamp"], unit="s").dt.round(
-        "min"
+    df_stats["Timestamp"] = to_datetime_index(
+        round_to_minutes(df_stats["Timestamp"].to_numpy())
     )
     df_stats = df_stats.groupby("Timestamp").agg(
         {
@@ -0,0 +1,438 @@
+# store merged wide matrices of time series in a compact binary format
+from functools import lru_cache
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# rounding to float32 is within 2^-24 relative error, unless a value underflows
+FLOAT32_TOLERANCE = 2**-24  # relative error allowed when downcasting to float32
+FLOAT32_ABS_TOLERANCE = 1e-6  # absolute error allowed when downcasting to float32
+SPARSE_THRESHOLD = 0.9  # least fraction of zeros of a sparse column
+SPARSE_COLUMNS_KEY = b"sparse_columns"
+COLUMN_INDEX_KEY = b"column_index"
+ROW_GROUP_SIZE = 1440  # a day of minutes
+CHUNK_SIZE = 1440  # rows of time series read at once
+# columns of KPIs are prefixed by their metric, e.g. gc-metric-3-agg-kpi-2-mean
+KPI_COLUMN_PATTERN = re.compile(r"(.*?)-(?:agg-)?kpi-[0-9]+")
+
+
+def compact_df(
+    df: pd.DataFrame,
+    tolerance: float = FLOAT32_TOLERANCE,
+    abs_tolerance: float = FLOAT32_ABS_TOLERANCE,
+    sparse_threshold: float = SPARSE_THRESHOLD,
+) -> pd.DataFrame:
+    """
+    Downcast float columns to float32 where it is lossless, and store columns
+    with at least `sparse_threshold` zeros as sparse columns filled with 0.
+
+    A column is lossless in float32 if each value is exactly a float32, or
+    rounds to one within both the relative error `tolerance` and the absolute
+    error `abs_tolerance`. The absolute bound keeps large values such as
+    cumulative counters in float64, where float32 would lose their
+    differences, e.g. 1e12 + 1 and 1e12 + 12345 both round to 999999995904.
+    """
+    float_columns = df.columns[
+        [pd.api.types.is_float_dtype(dtype) for dtype in df.dtypes]
+    ]
+    values = df[float_columns].to_numpy(dtype=np.float64)
+    with np.errstate(over="ignore", invalid="ignore"):
+        downcast_values = values.astype(np.float32)
+        errors = np.abs(downcast_values - values)
+    is_lossless = (
+        ((errors <= tolerance * np.abs(values)) & (errors <= abs_tolerance))
+        | (downcast_values == values)
+        | (np.isnan(values) & np.isnan(downcast_values))
+    ).all(axis=0)
+    is_sparse = (values == 0).mean(axis=0) >= sparse_threshold
+    compact_columns = dict()
+    for position, col in enumerate(float_columns):
+        column_values = (
+            downcast_values[:, position]
+            if is_lossless[position]
+            else values[:, position]
+        )
+        if is_sparse[position]:
+            column_values = pd.arrays.SparseArray(column_values, fill_value=0)
+        compact_columns[col] = column_values
+    return df.assign(**compact_columns)
+
+
+def get_sparse_columns(df: pd.DataFrame) -> list:
+    return [
+        col for col, dtype in df.dtypes.items() if isinstance(dtype, pd.SparseDtype)
+    ]
+
+
+def gen_column_index(columns: list) -> dict:
+    """Group columns by metric, columns that are not KPIs are their own metric."""
+    column_index = dict()
+    for col in columns:
+        match = KPI_COLUMN_PATTERN.match(col)
+        metric = col if match is None else match.group(1)
+        column_index.setdefault(metric, []).append(col)
+    return column_index
+
+
+class MatrixWriter:
+    """
+    Write a compacted dataframe to Parquet in chunks of rows in order of
+    time, which keeps dtypes and the index. Rows are written in row groups of
+    `ROW_GROUP_SIZE` rows, whose statistics let `read_matrix` skip row groups
+    out of a time range. Sparse columns are stored dense, where runs of zeros
+    are compressed. The metadata of the file lists sparse columns and the
+    columns of each metric, see `gen_column_index`. All chunks are written
+    with the dtypes and sparse columns of the first one, unless `dtypes` of
+    all columns are given, where sparse dtypes mark sparse columns. Chunks
+    are then cast to them while they are converted to Arrow.
+    """
+
+    def __init__(self, path: str, dtypes: dict = None):
+        self.path = path
+        self.dtypes = dtypes
+        self.schema = None
+        self.writer = None
+
+    def __enter__(self) -> "MatrixWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, df: pd.DataFrame):
+        sparse_columns = get_sparse_columns(df)
+        # much faster than astype to a dense dtype
+        df_dense = df.assign(
+            **{col: df[col].sparse.to_dense().to_numpy() for col in sparse_columns}
+        )
+        if self.schema is None:
+            df_schema = df_dense.iloc[:0]
+            if self.dtypes is not None:
+                sparse_columns = [
+                    col
+                    for col, dtype in self.dtypes.items()
+                    if isinstance(dtype, pd.SparseDtype)
+                ]
+                df_schema = df_schema.astype(
+                    {
+                        col: (
+                            dtype.subtype
+                            if isinstance(dtype, pd.SparseDtype)
+                            else dtype
+                        )
+                        for col, dtype in self.dtypes.items()
+                    }
+                )
+            table = pa.Table.from_pandas(df_schema, preserve_index=True)
+            metadata = dict(table.schema.metadata or {})
+            metadata[SPARSE_COLUMNS_KEY] = json.dumps(sparse_columns)
+            metadata[COLUMN_INDEX_KEY] = json.dumps(gen_column_index(df.columns))
+            self.schema = table.schema.with_metadata(metadata)
+            # statistics of other columns would make the footer as large as
+            # thousands of columns times row groups, which slows down opening
+            self.writer = pq.ParquetWriter(
+                self.path, self.schema, write_statistics=["timestamp"]
+            )
+        table = pa.Table.from_pandas(df_dense, schema=self.schema, preserve_index=True)
+        self.writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def write_matrix(df: pd.DataFrame, path: str):
+    """Write a compacted dataframe to Parquet sorted by timestamp, see `MatrixWriter`."""
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+    with MatrixWriter(path) as writer:
+        writer.write(df)
+
+
+@lru_cache(maxsize=8)
+def read_file_metadata(path: str, mtime: int) -> pq.FileMetaData:
+    return pq.read_metadata(path)
+
+
+def get_file_metadata(path: str) -> pq.FileMetaData:
+    """
+    Get the footer of a Parquet file, which is cached as long as the file is
+    unchanged, since parsing the footer of thousands of columns dominates
+    reading a few of them.
+    """
+    return read_file_metadata(path, os.stat(path).st_mtime_ns)
+
+
+def read_column_index(path: str) -> dict:
+    """Read the columns of each metric from the metadata of a matrix file."""
+    schema = get_file_metadata(path).schema.to_arrow_schema()
+    metadata = schema.metadata or {}
+    if COLUMN_INDEX_KEY not in metadata:
+        return gen_column_index([col for col in schema.names if col != "timestamp"])
+    return json.loads(metadata[COLUMN_INDEX_KEY])
+
+
+def find_columns(path: str, metrics: list = None, substrings: list = None) -> list:
+    """
+    Find columns of a matrix file that belong to any of the given metrics or
+    contain any of the given substrings, without reading any values.
+    """
+    column_index = read_column_index(path)
+    columns = []
+    for metric, metric_columns in column_index.items():
+        if metrics is not None and metric in metrics:
+            columns += metric_columns
+        elif substrings is not None:
+            columns += [
+                col
+                for col in metric_columns
+                if any(substring in col for substring in substrings)
+            ]
+    return columns
+
+
+def select_row_groups(parquet_file: pq.ParquetFile, start=None, end=None) -> list:
+    """Select row groups with timestamps between `start` and `end`."""
+    metadata = parquet_file.metadata
+    timestamp_position = parquet_file.schema_arrow.get_field_index("timestamp")
+    row_groups = []
+    for row_group in range(metadata.num_row_groups):
+        statistics = metadata.row_group(row_group).column(timestamp_position).statistics
+        if statistics is not None and statistics.has_min_max:
+            if start is not None and pd.Timestamp(statistics.max) < pd.Timestamp(start):
+                continue
+            if end is not None and pd.Timestamp(statistics.min) > pd.Timestamp(end):
+                continue
+        row_groups.append(row_group)
+    return row_groups
+
+
+def select_timestamps(timestamps: pd.DatetimeIndex, start=None, end=None) -> np.ndarray:
+    """Mask timestamps between `start` and `end`, which need not be sorted."""
+    is_selected = np.full(len(timestamps), True)
+    if start is not None:
+        is_selected &= timestamps >= pd.Timestamp(start)
+    if end is not None:
+        is_selected &= timestamps <= pd.Timestamp(end)
+    return is_selected
+
+
+def read_matrix(
+    path: str, columns: list = None, start=None, end=None, sparse: bool = True
+) -> pd.DataFrame:
+    """
+    Read a dataframe written by `write_matrix` with its sparse columns.
+
+    Parameters
+    ----------
+    path : str
+        path of the Parquet file
+    columns : list
+        columns to read, all columns if None
+    start, end
+        first and last timestamp to read, inclusive, open if None
+    sparse : bool
+        whether to restore sparse columns, which are read dense otherwise
+    """
+    parquet_file = pq.ParquetFile(path, metadata=get_file_metadata(path))
+    row_groups = select_row_groups(parquet_file, start, end)
+    df = parquet_file.read_row_groups(
+        row_groups, columns=columns, use_pandas_metadata=True
+    ).to_pandas()
+    if start is not None or end is not None:
+        df = df[select_timestamps(df.index, start, end)]
+    if not sparse:
+        return df
+    metadata = parquet_file.schema_arrow.metadata or {}
+    sparse_columns = [
+        col
+        for col in json.loads(metadata.get(SPARSE_COLUMNS_KEY, b"[]"))
+        if col in df.columns
+    ]
+    # much faster than astype to a sparse dtype
+    return df.assign(
+        **{
+            col: pd.arrays.SparseArray(df[col].to_numpy(), fill_value=0)
+            for col in sparse_columns
+        }
+    )
+
+
+def read_matrix_dtypes(path: str) -> dict:
+    """Read the dtypes of the columns of a matrix file, with sparse columns."""
+    schema = get_file_metadata(path).schema.to_arrow_schema()
+    sparse_columns = json.loads((schema.metadata or {}).get(SPARSE_COLUMNS_KEY, b"[]"))
+    dtypes = {
+        field.name: np.dtype(field.type.to_pandas_dtype())
+        for field in schema
+        if field.name != "timestamp"
+    }
+    for col in sparse_columns:
+        dtypes[col] = pd.SparseDtype(dtypes[col], 0)
+    return dtypes
+
+
+def get_output_formats(storage_format: str) -> list:
+    """
+    Get the formats to write merged time series in. CSV files are accompanied
+    by an indexed Parquet file, so that readers can load projected columns and
+    time ranges of them, see `read_time_series`.
+    """
+    if storage_format == "csv":
+        return ["csv", "parquet"]
+    return [storage_format]
+
+
+def write_time_series(df: pd.DataFrame, path: str, storage_format: str = "csv"):
+    """
+    Write a wide dataframe of time series indexed by timestamp to
+    `{path}.csv`, or compacted to `{path}.parquet`, see `compact_df`.
+    """
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+    with TimeSeriesWriter(path, storage_format) as writer:
+        writer.write(df)
+
+
+def read_time_series(
+    path: str, storage_format: str = "csv", columns: list = None, start=None, end=None
+) -> pd.DataFrame:
+    """
+    Read a dataframe written by `write_time_series` indexed by timestamp, with
+    only the given columns and timestamps between `start` and `end` if given,
+    see `read_matrix`. CSV files are parsed in full.
+    """
+    if storage_format == "csv":
+        usecols = None if columns is None else ["timestamp"] + columns
+        df = pd.read_csv(f"{path}.csv", usecols=usecols).set_index("timestamp")
+        if start is not None or end is not None:
+            df = df[select_timestamps(pd.to_datetime(df.index), start, end)]
+        return df
+    elif storage_format == "parquet":
+        return read_matrix(f"{path}.parquet", columns, start, end)
+    else:
+        raise ValueError(f"Unsupported storage format {storage_format}!")
+
+
+class TimeSeriesWriter:
+    """
+    Append chunks of rows of a wide dataframe of time series indexed by
+    timestamp, in order of time, to `{path}.csv`, or compacted to
+    `{path}.parquet`, see `write_time_series`.
+
+    Parameters
+    ----------
+    path : str
+        path of the file without extension
+    storage_format : str
+        "csv" or "parquet"
+    dtypes : dict
+        dtypes of columns in Parquet, see `MatrixWriter`, which are otherwise
+        decided by `compact_df` on the first chunk. Giving them avoids
+        downcasting a column that is lossless in float32 only in the first
+        chunk.
+    """
+
+    def __init__(self, path: str, storage_format: str = "csv", dtypes: dict = None):
+        if storage_format not in ["csv", "parquet"]:
+            raise ValueError(f"Unsupported storage format {storage_format}!")
+        self.path = f"{path}.{storage_format}"
+        self.storage_format = storage_format
+        self.dtypes = dtypes
+        self.matrix_writer = MatrixWriter(self.path, dtypes)
+        self.num_rows = 0
+
+    def __enter__(self) -> "TimeSeriesWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, df: pd.DataFrame):
+        if self.storage_format == "csv":
+            is_first = self.num_rows == 0
+            df.to_csv(self.path, mode="w" if is_first else "a", header=is_first)
+        elif self.dtypes is None:
+            self.matrix_writer.write(compact_df(df))
+        else:
+            self.matrix_writer.write(df)
+        self.num_rows += len(df)
+
+    def close(self):
+        self.matrix_writer.close()
+
+
+def iter_aligned_chunks(
+    path: str, storage_format: str, timestamp_chunks: list, chunk_size: int = CHUNK_SIZE
+):
+    """
+    Read a file written by `write_time_series` in chunks of rows aligned to
+    each of the sorted `timestamp_chunks`, with NaN at timestamps missing in
+    the file, so that only about a chunk of rows is held in memory. CSV files
+    are read sequentially and Parquet files by time range, see `read_matrix`,
+    with sparse columns read dense.
+    CSV files must be sorted by timestamp, as `write_time_series` writes them,
+    since rows of a chunk that come after later rows would be missed.
+    """
+    if storage_format == "parquet":
+        for timestamps in timestamp_chunks:
+            yield read_matrix(
+                f"{path}.parquet",
+                start=timestamps[0],
+                end=timestamps[-1],
+                sparse=False,
+            ).reindex(timestamps)
+        return
+    if storage_format != "csv":
+        raise ValueError(f"Unsupported storage format {storage_format}!")
+    reader = pd.read_csv(f"{path}.csv", index_col="timestamp", chunksize=chunk_size)
+    last_timestamp = None
+
+    def read_next_rows() -> pd.DataFrame:
+        nonlocal last_timestamp
+        df_next = next(reader, None)
+        if df_next is None:
+            return None
+        df_next.index = pd.to_datetime(df_next.index)
+        if not df_next.index.is_monotonic_increasing or (
+            last_timestamp is not None and df_next.index[0] < last_timestamp
+        ):
+            raise ValueError(
+                f"{path}.csv is not sorted by timestamp, "
+                + "rewrite it with write_time_series!"
+            )
+        last_timestamp = df_next.index[-1]
+        return df_next
+
+    # rows read but not yet yielded
+    df_buffer = pd.read_csv(f"{path}.csv", index_col="timestamp", nrows=0)
+    df_buffer.index = pd.to_datetime(df_buffer.index)
+    is_exhausted = False
+    for timestamps in timestamp_chunks:
+        # read until rows pass the end of the chunk
+        while not is_exhausted and (
+            len(df_buffer) == 0 or df_buffer.index[-1] <= timestamps[-1]
+        ):
+            df_next = read_next_rows()
+            if df_next is None:
+                is_exhausted = True
+            else:
+                # rows before the chunk, like a source starting before the
+                # first timestamp, are dropped as they are read
+                df_next = df_next[df_next.index >= timestamps[0]]
+                if len(df_buffer) == 0:
+                    # an empty buffer would turn the dtypes to object
+                    df_buffer = df_next
+                else:
+                    df_buffer = pd.concat([df_buffer, df_next])
+        is_in_chunk = df_buffer.index <= timestamps[-1]
+        yield df_buffer[is_in_chunk].reindex(timestamps)
+        df_buffer = df_buffer[~is_in_chunk]
+    # rows out of order in the rest of the file would belong to yielded chunks
+    while not is_exhausted:
+        is_exhausted = read_next_rows() is None
@@ -1,15 +1,17 @@
 # Aggregate each metric from each day and then merge all 14 days' time series
+from concurrent.futures import ProcessPoolExecutor
 import json
 import os
-import warnings
 import numpy as np
 import pandas as pd
 from app.processing.prometheus.data_preprocess import (
     METRIC_PATH,
-    Metric,
+    MetricMatrix,
     get_exp_names,
-    get_metric,
+    get_metric_matrix,
+    read_metric_matrix,
 )
+from app.processing.stats import aggregate_groups
 
 TARGET_METRIC_NAMES_PATH = os.path.join(METRIC_PATH, "target_metrics.csv")
 AGGREGATE_OUTPUT_PATH = os.path.join(METRIC_PATH, "prometheus_aggregated")
@@ -212,45 +214,63 @@ def aggregate(
     aggregate_funcs: list,
 ):
     new_kpi_map_list = []
-    new_kpi_map_index = 1
-    df_agg_list = []
+    group_columns = []  # positions of columns in df_kpi of each new KPI
+    # map KPI indices to positions of their columns once
+    column_positions = {
+        int(column.removeprefix("value-")): position
+        for position, column in enumerate(df_kpi.columns)
+    }
+    kpi_keys = df_kpi_indices_to_agg.index.names
     for row in df_kpi_indices_to_agg.itertuples():
+        # generate indices to be grouped
+        positions = [column_positions[i] for i in set(row[1]) if i in column_positions]
+        if len(positions) == 0:
+            continue
         # generate new KPI
-        kpi_keys = df_kpi_indices_to_agg.index.names
         kpi_values = row[0]
         if type(kpi_values) is not tuple:
             kpi_values = [kpi_values]
         kpi = {kpi_keys[i]: kpi_values[i] for i in range(len(kpi_keys))}
-        new_kpi_map = {"index": new_kpi_map_index, "kpi": kpi}
-
-        # generate indices to be grouped
-        indices_in_df_kpi = [
-            int(column.lstrip("value-")) for column in df_kpi.columns.to_list()
-        ]
-        valid_indices = list(set(row[1]) & set(indices_in_df_kpi))
-        columns_to_agg = [f"value-{i}" for i in valid_indices]
-
-        if len(columns_to_agg) == 1:
-            new_kpi_map_list.append(new_kpi_map)
-            single_column_name = columns_to_agg[0]
-            df_agg_list.append(
-                df_kpi[single_column_name].rename(f"agg-kpi-{new_kpi_map_index}")
-            )
-            new_kpi_map_index += 1
-            continue
-        elif len(columns_to_agg) == 0:
+        new_kpi_map_list.append({"index": len(new_kpi_map_list) + 1, "kpi": kpi})
+        group_columns.append(positions)
+    if len(group_columns) == 0:
+        return
+    values = df_kpi.to_numpy(dtype=float)
+    # merge columns of groups with more than 1 column at once
+    merged_groups = [positions for positions in group_columns if len(positions) > 1]
+    if len(merged_groups) > 0:
+        merged_values = aggregate_groups(
+            values[:, np.concatenate(merged_groups)],
+            [len(positions) for positions in merged_groups],
+            aggregate_funcs,
+        )
+    # single columns are kept, merged groups get one column per function
+    agg_column_names = []
+    agg_column_positions = []  # positions in values followed by merged_values
+    num_merged_values = len(merged_groups) * len(aggregate_funcs)
+    merged_group_index = 0
+    for new_kpi_map, positions in zip(new_kpi_map_list, group_columns):
+        new_kpi_map_index = new_kpi_map["index"]
+        if len(positions) == 1:
+            agg_column_names.append(f"agg-kpi-{new_kpi_map_index}")
+            agg_column_positions.append(num_merged_values + positions[0])
             continue
-        new_kpi_map_list.append(new_kpi_map)
-        # merge more than 1 columns
-        df_metric_to_agg = df_kpi[columns_to_agg]
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            df_metric_agg = df_metric_to_agg.agg(aggregate_funcs, axis=1).add_prefix(
-                f"agg-kpi-{new_kpi_map_index}-"
+        for func_index, func in enumerate(aggregate_funcs):
+            agg_column_names.append(f"agg-kpi-{new_kpi_map_index}-{func}")
+            agg_column_positions.append(
+                merged_group_index * len(aggregate_funcs) + func_index
             )
-        df_agg_list.append(df_metric_agg)
-        new_kpi_map_index += 1
-    df_complete_agg = pd.concat(df_agg_list, axis=1)
+        merged_group_index += 1
+    all_values = values
+    if len(merged_groups) > 0:
+        all_values = np.hstack(
+            [merged_values.reshape(len(values), num_merged_values), values]
+        )
+    df_complete_agg = pd.DataFrame(
+        all_values[:, agg_column_positions],
+        index=df_kpi.index,
+        columns=agg_column_names,
+    )
     if not df_complete_agg.empty:
         with open(
             os.path.join(agg_exp_path, f"metric-{metric_index}-kpi-map.json"),
@@ -287,64 +307,89 @@ def aggregate_metric(
         adapt_no_agg_time_series(metric_index, agg_exp_path, df_kpi_map, df_kpi)
 
 
-def aggregate_by_day():
+def aggregate_metric_matrix(matrix: MetricMatrix, metric_index: int, agg_exp_path: str):
+    if matrix.num_series == 0:
+        print(f"\tNo time series in {matrix.metric_name}!")
+        return
+    aggregate_metric(
+        matrix.metric_name,
+        metric_index,
+        agg_exp_path,
+        matrix.to_df_kpi_map(),
+        matrix.to_df_kpi(),
+    )
+
+
+def aggregate_metric_of_day(
+    metric_name: str, metric_index: int, exp_name: str, agg_exp_path: str
+):
+    """Aggregate a metric of an experiment day, which is a unit of `aggregate_by_day`."""
+    print(f"Processing {metric_index+1} {metric_name} on {exp_name} ...")
+    matrix = get_metric_matrix(exp_name, metric_name)
+    aggregate_metric_matrix(matrix, metric_index, agg_exp_path)
+
+
+def aggregate_metric_directly(
+    metric_name: str, metric_index: int, metric_path: str, aggregate_output_path: str
+):
+    """Aggregate a metric of a collected experiment, see `aggregate_directly`."""
+    print(f"Processing {metric_index+1} {metric_name} ...")
+    matrix = read_metric_matrix(
+        os.path.join(metric_path, f"metric-{metric_index}-day-1.json"),
+        metric_name,
+    )
+    aggregate_metric_matrix(matrix, metric_index, aggregate_output_path)
+
+
+def run_units(func, units: list, max_workers: int):
+    """
+    Run independent units of aggregation one after another, or on a pool of
+    `max_workers` processes. Each unit writes its own files, so the output
+    doesn't depend on the order in which units finish.
+    """
+    if max_workers <= 1:
+        for unit in units:
+            func(*unit)
+        return
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, *unit) for unit in units]
+        for future in futures:
+            # raise the first failure in the order of units
+            future.result()
+
+
+def aggregate_by_day(max_workers: int = 1):
     if not os.path.exists(AGGREGATE_OUTPUT_PATH):
         os.mkdir(AGGREGATE_OUTPUT_PATH)
     df_metric_names = pd.read_csv(TARGET_METRIC_NAMES_PATH)
     metric_names = df_metric_names["name"]
     exp_names = get_exp_names()
-    num_metrics = len(metric_names)
+    # create experiment folders before running units in parallel
+    for exp_name in exp_names:
+        agg_exp_path = os.path.join(AGGREGATE_OUTPUT_PATH, exp_name)
+        if not os.path.exists(agg_exp_path):
+            os.mkdir(agg_exp_path)
+    units = []
     for metric_name in metric_names:
         metric_index = df_metric_names[df_metric_names["name"] == metric_name].index[0]
-        print(f"Processing {metric_index+1}/{num_metrics} {metric_name} ...")
         for exp_name in exp_names:
-            print(f"\ton {exp_name} ...")
-            # create experiment folder if not exists
             agg_exp_path = os.path.join(AGGREGATE_OUTPUT_PATH, exp_name)
-            if not os.path.exists(agg_exp_path):
-                os.mkdir(agg_exp_path)
-            metric = get_metric(exp_name, metric_name)
-            kpi_map_list = []  # contains each metadata from metric items
-            metric_items_df_list = []  # contains each dataframe from metric items
-            for i in range(metric.num_metric_items):
-                item = metric.metric_items[i]
-                metric_items_df_list.append(
-                    item.values.set_index("timestamp").add_suffix(f"-{i}")
-                )
-                kpi_map_list.append(item.metadata)
-            df_kpi_map = pd.DataFrame(kpi_map_list)
-            df_kpi = pd.concat(metric_items_df_list, axis=1)
-            aggregate_metric(
-                metric_name, metric_index, agg_exp_path, df_kpi_map, df_kpi
-            )
+            units.append((metric_name, metric_index, exp_name, agg_exp_path))
+    run_units(aggregate_metric_of_day, units, max_workers)
 
 
-def aggregate_directly(metric_path: str, aggregate_output_path: str):
+def aggregate_directly(
+    metric_path: str, aggregate_output_path: str, max_workers: int = 1
+):
     if not os.path.exists(aggregate_output_path):
         os.mkdir(aggregate_output_path)
     df_metric_names = pd.read_csv(TARGET_METRIC_NAMES_PATH)
     metric_names = df_metric_names["name"]
-    num_metrics = len(metric_names)
+    units = []
     for metric_name in metric_names:
         metric_index = df_metric_names[df_metric_names["name"] == metric_name].index[0]
-        print(f"Processing {metric_index+1}/{num_metrics} {metric_name} ...")
-        metric_path = os.path.join(metric_path, f"metric-{metric_index}-day-1.json")
-        with open(metric_path) as fp:
-            metric_data = json.load(fp)
-        metric = Metric(metric_name, metric_data)
-        kpi_map_list = []  # contains each metadata from metric items
-        metric_items_df_list = []  # contains each dataframe from metric items
-        for i in range(metric.num_metric_items):
-            item = metric.metric_items[i]
-            metric_items_df_list.append(
-                item.values.set_index("timestamp").add_suffix(f"-{i}")
-            )
-            kpi_map_list.append(item.metadata)
-        df_kpi_map = pd.DataFrame(kpi_map_list)
-        df_kpi = pd.concat(metric_items_df_list, axis=1)
-        aggregate_metric(
-            metric_name, metric_index, aggregate_output_path, df_kpi_map, df_kpi
-        )
+        units.append((metric_name, metric_index, metric_path, aggregate_output_path))
+    run_units(aggregate_metric_directly, units, max_workers)
 
 
 def count_kpis():
@@ -357,13 +402,7 @@ def count_kpis():
         metric_index = df_metric_names[df_metric_names["name"] == metric_name].index[0]
         print(f"Processing {metric_index+1}/{num_metrics} {metric_name} ...")
         for exp_name in exp_names:
-            metric = get_metric(exp_name, metric_name)
-            kpi_map_list = []  # contains each metadata from metric items
-            for i in range(metric.num_metric_items):
-                item = metric.metric_items[i]
-                kpi_map_list.append(item.metadata)
-            df_kpi_map = pd.DataFrame(kpi_map_list)
-            num_kpis += len(df_kpi_map)
+            num_kpis += get_metric_matrix(exp_name, metric_name).num_series
     print(num_kpis)
 
 
@@ -1,9 +1,19 @@
+from collections import OrderedDict
 from functools import reduce
 import json
 import logging
 import os
 
+import ijson
+import numpy as np
 import pandas as pd
+from app.processing.kpi_registry import KpiRegistry
+from app.processing.time_buckets import (
+    bucket_by_minute,
+    round_to_minutes,
+    segment_means,
+    to_datetime_index,
+)
 
 METRIC_PATH = "/Users/ketai/Library/CloudStorage/OneDrive-USI/Thesis/experiments/normal"
 COMBINED_METRIC_PATH = os.path.join(METRIC_PATH, "combined")
@@ -51,16 +61,80 @@ class Metric:
 class MetricItem:
     def __init__(self, result_item: dict):
         self.metadata = result_item["metric"]
+        points = np.array(result_item["values"], dtype=np.float64).reshape(-1, 2)
+        minutes, values = bucket_by_minute(points[:, 0], points[:, 1])
         self.values = pd.DataFrame(
-            result_item["values"], columns=["timestamp", "value"]
-        ).astype({"timestamp": "int64", "value": "float64"})
-        self.values["timestamp"] = pd.to_datetime(
-            self.values["timestamp"], unit="s"
-        ).dt.round("min")
-        if len(self.values["timestamp"]) != len(
-            self.values["timestamp"].drop_duplicates()
-        ):
-            self.values = self.values.groupby("timestamp").agg("mean").reset_index()
+            {"timestamp": to_datetime_index(minutes), "value": values}
+        )
+
+
+class MetricMatrix:
+    """
+    All series of a range metric in arrays instead of one dataframe per
+    series. Labels of the series are kept in a table with dictionary-encoded
+    columns, points are rounded to minutes on a sorted grid shared by all
+    series and values are kept in a 2-D array of (minute, series), which is
+    NaN where a series has no point. Points of a series in the same minute
+    are averaged as in `MetricItem`.
+    """
+
+    def __init__(
+        self, name: str, labels: pd.DataFrame, minutes: np.ndarray, values: np.ndarray
+    ):
+        self.metric_name = name
+        self.labels = labels
+        self.minutes = minutes  # in seconds
+        self.values = values
+        self.num_series = len(labels)
+
+    @classmethod
+    def from_result_items(cls, name: str, result_items) -> "MetricMatrix":
+        """
+        Build the matrix in one pass over the items of the result of a range
+        query, items without values are skipped.
+        """
+        metadata_list = []
+        series_points = []  # (timestamps, values) of each series
+        for item in result_items:
+            if not item["values"]:
+                continue
+            metadata_list.append(item["metric"])
+            points = np.array(item["values"], dtype=np.float64).reshape(-1, 2)
+            series_points.append(points)
+        num_series = len(metadata_list)
+        if num_series == 0:
+            return cls(
+                name,
+                pd.DataFrame(),
+                np.empty(0, dtype=np.int64),
+                np.empty((0, 0), dtype=np.float64),
+            )
+        points = np.concatenate(series_points)
+        series = np.repeat(
+            np.arange(num_series), [len(points) for points in series_points]
+        )
+        minutes, rows = np.unique(round_to_minutes(points[:, 0]), return_inverse=True)
+        # average values of each (minute, series)
+        cells, cell_values = segment_means(rows * num_series + series, points[:, 1])
+        values = np.full(len(minutes) * num_series, np.nan)
+        values[cells] = cell_values
+        labels = pd.DataFrame(metadata_list).astype("category")
+        return cls(name, labels, minutes, values.reshape(len(minutes), num_series))
+
+    def to_df_kpi_map(self) -> pd.DataFrame:
+        """Get labels of each series as plain columns with NaN for missing labels."""
+        return self.labels.astype(object)
+
+    def to_df_kpi(self) -> pd.DataFrame:
+        """
+        Get values as a wide dataframe indexed by timestamp with a `value-{i}`
+        column for the i-th series.
+        """
+        return pd.DataFrame(
+            self.values,
+            index=to_datetime_index(self.minutes),
+            columns=[f"value-{i}" for i in range(self.num_series)],
+        )
 
 
 def get_metric_names(exp_name: str) -> pd.Series:
@@ -79,46 +153,152 @@ def get_exp_names() -> list:
 
 
 def get_metric_index(exp_name: str, metric_name: str):
-    metric_names_map_path = os.path.join(
-        METRIC_PATH, exp_name, "metrics", "metric_names_map.json"
-    )
-    with open(metric_names_map_path) as fp:
-        metric_names_map = list(json.load(fp).values())
-    return metric_names_map.index(metric_name) + 1
+    return METRIC_LOADER.get_metric_index(exp_name, metric_name)
 
 
-def get_metric(exp_name: str, metric_name: str) -> Metric:
-    metric_index = get_metric_index(exp_name, metric_name)
-    metric_path = os.path.join(
-        METRIC_PATH, exp_name, "metrics", f"metric-{metric_index}-day-1.json"
-    )
-    metric_data = None
+def iter_metric_items(fp):
+    """
+    Parse the series of a stored range metric incrementally, so that only one
+    series is decoded at a time instead of the whole file.
+    """
+    for item in ijson.items(fp, "result.item", use_float=True):
+        if item.get("values"):
+            yield MetricItem(item)
+
+
+def read_metric(metric_path: str, metric_name: str) -> Metric:
+    metric_items = None
     try:
-        with open(metric_path) as fp:
-            metric_data = json.load(fp)
-    except json.JSONDecodeError as e:
-        print(f"{metric_name} in {exp_name} cannot be decoded!")
-    return Metric(metric_name, metric_data)
+        with open(metric_path, "rb") as fp:
+            metric_items = list(iter_metric_items(fp))
+    except ijson.JSONError as e:
+        print(f"{metric_name} in {metric_path} cannot be decoded!")
+    return Metric(metric_name, metric_items)
+
+
+def read_metric_matrix(metric_path: str, metric_name: str) -> MetricMatrix:
+    """
+    Read a stored range metric as a `MetricMatrix` by streaming its series,
+    so that only the points of one series are held as Python objects at once.
+    """
+    try:
+        with open(metric_path, "rb") as fp:
+            return MetricMatrix.from_result_items(
+                metric_name, ijson.items(fp, "result.item", use_float=True)
+            )
+    except ijson.JSONError as e:
+        print(f"{metric_name} in {metric_path} cannot be decoded!")
+    return MetricMatrix.from_result_items(metric_name, [])
+
+
+class MetricLoader:
+    """
+    Load metrics of experiments with a bounded LRU cache keyed by experiment,
+    metric and the modification time of the metric file, so that each file is
+    parsed once per run as long as it is unchanged. Metrics in the cache are
+    shared, so they must not be modified.
+    """
+
+    MAX_SIZE = 32  # enough to hold a metric of all experiment days
+
+    def __init__(self, max_size: int = MAX_SIZE):
+        self.max_size = max_size
+        # (exp_name, metric_name, name of reader) -> (mtime, metric)
+        self.metrics = OrderedDict()
+        self.metric_names_maps = dict()  # exp_name -> (mtime, list of names)
+        self.hits = 0
+        self.misses = 0
+
+    def get_metric_index(self, exp_name: str, metric_name: str) -> int:
+        metric_names_map_path = os.path.join(
+            METRIC_PATH, exp_name, "metrics", "metric_names_map.json"
+        )
+        mtime = os.stat(metric_names_map_path).st_mtime_ns
+        cached = self.metric_names_maps.get(exp_name)
+        if cached is None or cached[0] != mtime:
+            with open(metric_names_map_path) as fp:
+                cached = (mtime, list(json.load(fp).values()))
+            self.metric_names_maps[exp_name] = cached
+        return cached[1].index(metric_name) + 1
+
+    def get_metric_path(self, exp_name: str, metric_name: str) -> str:
+        metric_index = self.get_metric_index(exp_name, metric_name)
+        return os.path.join(
+            METRIC_PATH, exp_name, "metrics", f"metric-{metric_index}-day-1.json"
+        )
+
+    def load(self, exp_name: str, metric_name: str, read_func):
+        """Load a metric with `read_func`, which is `read_metric` or `read_metric_matrix`."""
+        metric_path = self.get_metric_path(exp_name, metric_name)
+        mtime = os.stat(metric_path).st_mtime_ns
+        key = (exp_name, metric_name, read_func.__name__)
+        cached = self.metrics.get(key)
+        if cached is not None and cached[0] == mtime:
+            self.hits += 1
+            self.metrics.move_to_end(key)
+            return cached[1]
+        self.misses += 1
+        metric = read_func(metric_path, metric_name)
+        # a changed metric file replaces its outdated entry
+        self.metrics[key] = (mtime, metric)
+        self.metrics.move_to_end(key)
+        if len(self.metrics) > self.max_size:
+            self.metrics.popitem(last=False)
+        return metric
+
+    def get_metric(self, exp_name: str, metric_name: str) -> Metric:
+        return self.load(exp_name, metric_name, read_metric)
+
+    def get_metric_matrix(self, exp_name: str, metric_name: str) -> MetricMatrix:
+        # each matrix is read once by a unit of the process pool of
+        # `data_aggregate`, where a cached copy would only hold memory
+        return read_metric_matrix(
+            self.get_metric_path(exp_name, metric_name), metric_name
+        )
+
+    def cache_info(self) -> str:
+        return (
+            f"hits={self.hits}, misses={self.misses}, "
+            f"maxsize={self.max_size}, currsize={len(self.metrics)}"
+        )
+
+    def cache_clear(self):
+        self.metrics.clear()
+        self.metric_names_maps.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+METRIC_LOADER = MetricLoader()
+
+
+def get_metric(exp_name: str, metric_name: str) -> Metric:
+    return METRIC_LOADER.get_metric(exp_name, metric_name)
+
+
+def get_metric_matrix(exp_name: str, metric_name: str) -> MetricMatrix:
+    return METRIC_LOADER.get_metric_matrix(exp_name, metric_name)
 
 
 def gen_unique_kpi_maps(exp_names: list, metric_name: str) -> list:
-    unique_kpi_index = 1
-    unique_kpi_json_map = dict()  # dict of json strings of kpi maps
+    registry = KpiRegistry()
+    unique_kpi_maps = []
     for exp_name in exp_names:
         metric = get_metric(exp_name, metric_name)
         for i in range(len(metric.metric_items)):
             item = metric.metric_items[i]
-            unique_kpi_json = json.dumps(item.metadata, sort_keys=True)
-            if unique_kpi_json in unique_kpi_json_map:
-                unique_kpi_json_map[unique_kpi_json][exp_name] = i
+            unique_kpi_index = registry.register(item.metadata)
+            if unique_kpi_index <= len(unique_kpi_maps):
+                unique_kpi_maps[unique_kpi_index - 1][exp_name] = i
             else:
-                unique_kpi_json_map[unique_kpi_json] = {
-                    "index": unique_kpi_index,
-                    exp_name: i,
-                    "kpi": item.metadata,
-                }
-                unique_kpi_index += 1
-    return list(unique_kpi_json_map.values())
+                unique_kpi_maps.append(
+                    {
+                        "index": unique_kpi_index,
+                        exp_name: i,
+                        "kpi": registry.get_labels(unique_kpi_index),
+                    }
+                )
+    return unique_kpi_maps
 
 
 def clean_kpi_maps(unique_kpi_maps: list):
@@ -233,6 +413,7 @@ def merge_valid_prometheus_metrics():
             )
             num_added_kpis = len(merged_df.columns) - 1
             print(f"Extract {num_added_kpis} KPIs for metric {metric_name}")
+    print(f"Metric cache: {METRIC_LOADER.cache_info()}")
 
 
 def main():
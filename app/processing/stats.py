@@ -0,0 +1,179 @@
+# statistics of KPIs merged at each timestamp
+import numpy as np
+import pandas as pd
+
+MOMENT_FUNCS = ["mean", "std", "sum", "count"]
+ORDER_FUNCS = ["min", "max", "median"]
+
+
+def aggregate_rows(df: pd.DataFrame, funcs: list) -> pd.DataFrame:
+    """
+    Compute statistics of each row of a dataframe ignoring NaN, with the same
+    results as `df.agg(funcs, axis=1)` and `df.quantile(quantiles, axis=1)`.
+    Moments are computed in one sweep over the underlying array and each row
+    is sorted once for min, max, median and all quantiles.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        dataframe of KPIs to merge in each row
+    funcs : list
+        names of statistics among "min", "max", "mean", "median", "std", "sum"
+        and "count", or floats of quantiles between 0 and 1
+
+    Returns
+    -------
+    a dataframe with the same index as `df` and one column per statistic
+    """
+    values = df.to_numpy(dtype=np.float64)
+    num_rows = values.shape[0]
+    is_valid = ~np.isnan(values)
+    counts = is_valid.sum(axis=1)
+    result = np.empty((num_rows, len(funcs)), dtype=np.float64)
+    if any(func in MOMENT_FUNCS for func in funcs):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sums = np.where(is_valid, values, 0).sum(axis=1)
+            means = np.where(counts > 0, sums / counts, np.nan)
+            deviations = np.where(is_valid, values - means[:, None], 0)
+            stds = np.where(
+                counts > 1,
+                np.sqrt((deviations**2).sum(axis=1) / (counts - 1)),
+                np.nan,
+            )
+        moments = {"mean": means, "std": stds, "sum": sums, "count": counts}
+    if any(func not in MOMENT_FUNCS for func in funcs):
+        # NaN are sorted to the end of each row
+        sorted_values = np.sort(values, axis=1)
+    for position, func in enumerate(funcs):
+        if func in MOMENT_FUNCS:
+            result[:, position] = moments[func]
+        elif func == "min":
+            result[:, position] = sorted_values[:, 0]
+        elif func == "max":
+            last = np.maximum(counts - 1, 0)
+            result[:, position] = sorted_values[np.arange(num_rows), last]
+        elif func == "median":
+            result[:, position] = sorted_quantile(sorted_values, counts, 0.5)
+        elif isinstance(func, float):
+            result[:, position] = sorted_quantile(sorted_values, counts, func)
+        else:
+            raise ValueError(f"Unsupported statistic {func}!")
+    df_agg = pd.DataFrame(result, index=df.index, columns=funcs)
+    if "count" in funcs:
+        df_agg["count"] = counts
+    return df_agg
+
+
+def sorted_quantile(
+    sorted_values: np.ndarray, counts: np.ndarray, quantile: float
+) -> np.ndarray:
+    """
+    Linearly interpolated quantile of each row of an array sorted by row,
+    where the first `counts` values of each row are valid.
+    """
+    positions = quantile * np.maximum(counts - 1, 0)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    rows = np.arange(sorted_values.shape[0])
+    lower_values = sorted_values[rows, lower]
+    upper_values = sorted_values[rows, upper]
+    quantiles = lower_values + (upper_values - lower_values) * (positions - lower)
+    return np.where(counts > 0, quantiles, np.nan)
+
+
+def segment_quantile(
+    sorted_values: np.ndarray, starts: np.ndarray, counts: np.ndarray, quantile: float
+) -> np.ndarray:
+    """
+    Linearly interpolated quantile of each group of rows in each column of an
+    array sorted within groups, where group `g` starts at row `starts[g]` and
+    its first `counts[g]` values of each column are valid.
+
+    Returns
+    -------
+    2-D array of (group, column)
+    """
+    positions = quantile * np.maximum(counts - 1, 0)
+    lower = starts[:, None] + np.floor(positions).astype(np.int64)
+    upper = starts[:, None] + np.ceil(positions).astype(np.int64)
+    columns = np.arange(sorted_values.shape[1])
+    lower_values = sorted_values[lower, columns]
+    upper_values = sorted_values[upper, columns]
+    quantiles = lower_values + (upper_values - lower_values) * (
+        positions - np.floor(positions)
+    )
+    return np.where(counts > 0, quantiles, np.nan)
+
+
+def aggregate_groups(values: np.ndarray, group_sizes: list, funcs: list) -> np.ndarray:
+    """
+    Compute statistics of groups of columns in each row ignoring NaN, with
+    segment reductions over the whole array instead of one pass per group.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        2-D array of (timestamp, KPI) with columns of the same group next to
+        each other in the order of groups
+    group_sizes : list
+        number of columns of each group, all greater than 0
+    funcs : list
+        statistics to compute, see `aggregate_rows`
+
+    Returns
+    -------
+    3-D array of (timestamp, group, statistic)
+    """
+    num_rows = values.shape[0]
+    group_sizes = np.asarray(group_sizes, dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(group_sizes)[:-1]])
+    # reduce rows of a contiguous array of (KPI, timestamp), which is much faster
+    values = np.ascontiguousarray(values.T)
+    is_valid = ~np.isnan(values)
+    counts = np.add.reduceat(is_valid, starts, axis=0)
+    result = np.empty((len(group_sizes), num_rows, len(funcs)), dtype=np.float64)
+    if any(func in MOMENT_FUNCS for func in funcs):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sums = np.add.reduceat(np.where(is_valid, values, 0), starts, axis=0)
+            means = np.where(counts > 0, sums / counts, np.nan)
+            # mean of the group of each column
+            deviations = np.where(
+                is_valid, values - np.repeat(means, group_sizes, axis=0), 0
+            )
+            stds = np.where(
+                counts > 1,
+                np.sqrt(np.add.reduceat(deviations**2, starts, axis=0) / (counts - 1)),
+                np.nan,
+            )
+        moments = {"mean": means, "std": stds, "sum": sums, "count": counts}
+    sorted_values = None
+    if any(func not in MOMENT_FUNCS + ["min", "max"] for func in funcs):
+        # sort the columns of each group in each row, NaN at the end of each
+        # group, which also gives min and max
+        group_ids = np.repeat(np.arange(len(group_sizes)), group_sizes)
+        order = np.lexsort(
+            (values, np.broadcast_to(group_ids[:, None], values.shape)), axis=0
+        )
+        sorted_values = np.take_along_axis(values, order, axis=0)
+        del order
+    for position, func in enumerate(funcs):
+        if func in MOMENT_FUNCS:
+            result[:, :, position] = moments[func]
+        elif func in ["min", "max"] and sorted_values is not None:
+            last = 0 if func == "min" else np.maximum(counts - 1, 0)
+            result[:, :, position] = sorted_values[
+                starts[:, None] + last, np.arange(num_rows)
+            ]
+        elif func == "min":
+            # fmin and fmax ignore NaN unless all values are NaN
+            result[:, :, position] = np.fmin.reduceat(values, starts, axis=0)
+        elif func == "max":
+            result[:, :, position] = np.fmax.reduceat(values, starts, axis=0)
+        elif func == "median" or isinstance(func, float):
+            quantile = 0.5 if func == "median" else func
+            result[:, :, position] = segment_quantile(
+                sorted_values, starts, counts, quantile
+            )
+        else:
+            raise ValueError(f"Unsupported statistic {func}!")
+    return result.transpose(1, 0, 2)
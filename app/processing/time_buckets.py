@@ -0,0 +1,86 @@
+# round epoch seconds to minutes and merge points in the same minute
+import numpy as np
+import pandas as pd
+
+MINUTE = 60  # in seconds
+
+
+def round_to_minutes(timestamps) -> np.ndarray:
+    """
+    Round epoch seconds to the start of the nearest minute in seconds with
+    integer arithmetic. Ties are rounded half to even, as `dt.round("min")` does.
+    """
+    timestamps = np.asarray(timestamps).astype(np.int64)
+    minutes, seconds = np.divmod(timestamps, MINUTE)
+    half = MINUTE // 2
+    minutes += (seconds > half) | ((seconds == half) & (minutes % 2 == 1))
+    return minutes * MINUTE
+
+
+def segment_means(keys: np.ndarray, values: np.ndarray) -> tuple:
+    """
+    Average values with the same key ignoring NaN, as
+    `groupby(keys).agg("mean")` does, by sorting keys once and reducing
+    contiguous segments.
+
+    Parameters
+    ----------
+    keys : np.ndarray
+        int64 key of each row
+    values : np.ndarray
+        1-D or 2-D array of values with one row per key
+
+    Returns
+    -------
+    a tuple of sorted unique keys and an array of the mean values of each key,
+    which is NaN if all values of a key are NaN
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(keys) == 0 or np.all(keys[1:] > keys[:-1]):
+        # keys are already unique and sorted
+        return keys, values
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    values = values[order]
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    is_valid = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(is_valid, values, 0), starts, axis=0)
+    counts = np.add.reduceat(is_valid, starts, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return keys[starts], means
+
+
+def bucket_by_minute(timestamps, values) -> tuple:
+    """
+    Round timestamps in epoch seconds to minutes and average values of rows
+    in the same minute, see `segment_means`.
+    """
+    return segment_means(round_to_minutes(timestamps), values)
+
+
+def to_datetime_index(minutes: np.ndarray, name: str = "timestamp") -> pd.DatetimeIndex:
+    """Convert minutes in epoch seconds to a datetime index."""
+    return pd.DatetimeIndex(
+        np.asarray(minutes, dtype=np.int64)
+        .astype("datetime64[s]")
+        .astype("datetime64[ns]"),
+        name=name,
+    )
+
+
+def df_by_minute(df: pd.DataFrame, timestamp_column: str = "timestamp") -> pd.DataFrame:
+    """
+    Round the timestamps of a dataframe in epoch seconds to minutes and
+    average the other columns within minutes. The result is indexed by the
+    datetimes of the minutes.
+    """
+    value_columns = [col for col in df.columns if col != timestamp_column]
+    minutes, values = bucket_by_minute(
+        df[timestamp_column].to_numpy(), df[value_columns].to_numpy(dtype=np.float64)
+    )
+    return pd.DataFrame(
+        values.reshape(len(minutes), len(value_columns)),
+        index=to_datetime_index(minutes, timestamp_column),
+        columns=value_columns,
+    )
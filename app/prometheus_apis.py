@@ -1,35 +1,242 @@
 # GET https://prometheus.crab.alemira.com/api/v1/label/__name__/values
 # to get all names of metrics
+import asyncio
+import contextlib
+import json
+import random
+import re
 import requests, os, time
-from urllib3.exceptions import ConnectionError
+import aiohttp
+import ijson
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+MAX_RETRIES = 5
+# connect and read timeout in seconds for a single request
+REQUEST_TIMEOUT = (10, 300)
+# Prometheus rejects range queries returning more points per series than this
+MAX_POINTS_PER_SERIES = 11000
+# metrics with more series are queried in shards of at most this many series
+MAX_SERIES_PER_QUERY = 500
+# labels used to shard high-cardinality metrics, from the finest to the coarsest
+SHARD_LABELS = ["pod", "container", "node"]
+METRIC_NAME_PATTERN = re.compile(r"[a-zA-Z_:][a-zA-Z0-9_:]*")
+DURATION_UNITS = {
+    "ms": 0.001,
+    "s": 1,
+    "m": 60,
+    "h": 60 * 60,
+    "d": 60 * 60 * 24,
+    "w": 60 * 60 * 24 * 7,
+    "y": 60 * 60 * 24 * 365,
+}
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 60) -> float:
+    """Exponential backoff with full jitter before retrying the given attempt."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def is_retryable_status(status_code: int) -> bool:
+    """Client errors won't be fixed by retrying, except for rate limiting."""
+    return status_code >= 500 or status_code == 429
+
+
+def parse_duration(duration: str) -> float:
+    """Convert a Prometheus duration string like "1m" or "1h30m" to seconds."""
+    units = re.findall(r"(\d+)(ms|[smhdwy])", duration)
+    if units and "".join(value + unit for value, unit in units) == duration:
+        return sum(int(value) * DURATION_UNITS[unit] for value, unit in units)
+    try:
+        # Prometheus also accepts a plain number of seconds
+        return float(duration)
+    except ValueError:
+        raise ValueError(f"Invalid Prometheus duration {duration}!")
+
+
+def split_time_range(
+    start: str, end: str, step: str, max_points: int = MAX_POINTS_PER_SERIES
+) -> list:
+    """
+    Split a range query into sub-windows which return at most `max_points`
+    points per series. Each sub-window starts one step after the previous one
+    ends, so all windows share the evaluation grid of the original query.
+
+    Returns a list of (start, end) Unix timestamps in seconds, both inclusive.
+    """
+    start, end = float(start), float(end)
+    step_seconds = parse_duration(step)
+    window_seconds = step_seconds * (max_points - 1)
+    windows = []
+    window_start = start
+    while window_start <= end:
+        window_end = min(window_start + window_seconds, end)
+        windows.append(
+            tuple(
+                int(timestamp) if timestamp.is_integer() else timestamp
+                for timestamp in (window_start, window_end)
+            )
+        )
+        window_start = window_end + step_seconds
+    return windows
+
+
+def merge_range_results(results: list) -> dict:
+    """
+    Stitch the matrices of label shards and consecutive sub-window queries
+    back together per series fingerprint, i.e. its set of labels. Return None
+    if any piece failed, like a single failed query would.
+    """
+    series_map = dict()  # dict of json strings of series labels
+    for data in results:
+        if data is None:
+            return None
+        for item in data["result"]:
+            fingerprint = json.dumps(item["metric"], sort_keys=True)
+            if fingerprint in series_map:
+                series_map[fingerprint]["values"] += item["values"]
+            else:
+                series_map[fingerprint] = {
+                    "metric": item["metric"],
+                    "values": list(item["values"]),
+                }
+    return {"resultType": "matrix", "result": list(series_map.values())}
+
+
+def gen_shard_queries(name: str, series: list, max_series: int) -> list:
+    """
+    Shard the query of a metric into selectors on the first label of
+    `SHARD_LABELS` taking several values, so that each selector matches at most
+    `max_series` of the given series. Series without the label are queried by
+    an extra selector matching the empty label. A single shard is returned if
+    the metric doesn't need or can't be sharded.
+
+    Parameters
+    ----------
+    name : the name of the metric
+    series : label sets of the series of the metric, as returned by /api/v1/series
+    max_series : maximum number of series per shard
+    """
+    if len(series) <= max_series or not METRIC_NAME_PATTERN.fullmatch(name):
+        return [name]
+    for label in SHARD_LABELS:
+        counts = Counter(item.get(label, "") for item in series)
+        values = sorted(value for value in counts if value)
+        if len(values) > 1:
+            break
+    else:
+        return [name]
+    # pack label values greedily into shards of bounded size
+    shards = []
+    shard = []
+    num_shard_series = 0
+    for value in values:
+        if shard and num_shard_series + counts[value] > max_series:
+            shards.append(shard)
+            shard = []
+            num_shard_series = 0
+        shard.append(value)
+        num_shard_series += counts[value]
+    shards.append(shard)
+    # json strings are valid PromQL strings with escaped quotes and backslashes
+    queries = [
+        f"{name}{{{label}=~{json.dumps('|'.join(re.escape(v) for v in shard))}}}"
+        for shard in shards
+    ]
+    if "" in counts:
+        queries.append(f'{name}{{{label}=""}}')
+    return queries
 
 
 class PrometheusAPI:
     BASE_URL = "https://prometheus.crab.alemira.com/api/v1"
 
-    def __init__(self, username: str, password: str):
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        pool_maxsize: int = 16,
+        timeout: tuple = REQUEST_TIMEOUT,
+        max_retries: int = MAX_RETRIES,
+        max_points_per_series: int = MAX_POINTS_PER_SERIES,
+        max_series_per_query: int = MAX_SERIES_PER_QUERY,
+    ):
         self.username = username
         self.password = password
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_points_per_series = max_points_per_series
+        self.max_series_per_query = max_series_per_query
+        # reuse TLS connections and basic auth across all requests
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers.update({"Accept-Encoding": "gzip"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        params: dict = None,
+        data: dict = None,
+        stream: bool = False,
+    ) -> requests.Response:
+        """
+        Send a request through the pooled session, retrying connection errors,
+        timeouts and retryable status codes with exponential backoff. If
+        `stream` is True, the body is left unread for incremental parsing.
+        """
+        for attempt in range(self.max_retries):
+            is_last_attempt = attempt == self.max_retries - 1
+            try:
+                r = self.session.request(
+                    method,
+                    url,
+                    params=params,
+                    data=data,
+                    timeout=self.timeout,
+                    stream=stream,
+                )
+                if (
+                    r.status_code < 300
+                    or not is_retryable_status(r.status_code)
+                    or is_last_attempt
+                ):
+                    break
+                r.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if is_last_attempt:
+                    raise
+                print(f"Retry request to {url} after error: {e}")
+            time.sleep(backoff_delay(attempt))
+        r.raise_for_status()
+        return r
+
+    def get(
+        self, url: str, params: dict = None, stream: bool = False
+    ) -> requests.Response:
+        return self.request("GET", url, params=params, stream=stream)
+
+    def post(self, url: str, data: dict, stream: bool = False) -> requests.Response:
+        """
+        Send a form-encoded POST request, which keeps long selectors of label
+        shards out of the URL, whose length is limited by proxies.
+        """
+        return self.request("POST", url, data=data, stream=stream)
 
     def get_metric_names(self) -> list:
         url = os.path.join(self.BASE_URL, "label", "__name__", "values")
-        for _ in range(3):
-            r = requests.get(url, auth=(self.username, self.password))
-            if r.status_code < 300:
-                break
-            time.sleep(1)
-        r.raise_for_status()
+        r = self.get(url)
         return r.json()["data"]
 
     def get_instant_metric(self, name: str) -> dict:
         url = os.path.join(self.BASE_URL, "query")
         payload = {"query": name}
-        for _ in range(3):
-            r = requests.get(url, params=payload, auth=(self.username, self.password))
-            if r.status_code < 300:
-                break
-            time.sleep(1)
-        r.raise_for_status()
+        r = self.get(url, params=payload)
         json = r.json()
         if json["status"] == "success":
             return json["data"]
@@ -37,9 +244,30 @@ class PrometheusAPI:
             print(f"Fail to get instant metric {name}. [JSON] {json}")
             return None
 
+    def get_series(self, match: str, start: str, end: str) -> list:
+        """Get label sets of the series matching the selector over a range of time."""
+        url = os.path.join(self.BASE_URL, "series")
+        payload = {"match[]": match, "start": start, "end": end}
+        r = self.post(url, payload)
+        return r.json()["data"]
+
+    def plan_shard_queries(self, name: str, start: str, end: str) -> list:
+        """
+        Probe the series cardinality of a metric and shard it if necessary.
+        Sharding is disabled if `max_series_per_query` is None.
+        """
+        is_metric_name = METRIC_NAME_PATTERN.fullmatch(name) is not None
+        if self.max_series_per_query is None or not is_metric_name:
+            return [name]
+        series = self.get_series(name, start, end)
+        return gen_shard_queries(name, series, self.max_series_per_query)
+
     def get_range_metric(self, name: str, start: str, end: str, step: str):
         """
-        Get metric by name over a range of time.
+        Get metric by name over a range of time. Metrics with more series than
+        `max_series_per_query` are sharded by label, and ranges exceeding the
+        points per series limit of Prometheus are split into sub-windows. All
+        pieces are fetched concurrently and merged back into a single matrix.
 
         Parameters
         ----------
@@ -48,26 +276,224 @@ class PrometheusAPI:
         end : end Unix timestamp in seconds, inclusive
         step : query resolution step width in Prometheus duration string format
         """
+        queries = self.plan_shard_queries(name, start, end)
+        windows = split_time_range(start, end, step, self.max_points_per_series)
+        if len(queries) == 1 and len(windows) == 1:
+            return self.query_range(name, start, end, step)
+        jobs = [(query, *window) for query in queries for window in windows]
+        with ThreadPoolExecutor(
+            max_workers=min(len(jobs), self.pool_maxsize)
+        ) as executor:
+            results = list(executor.map(lambda job: self.query_range(*job, step), jobs))
+        return merge_range_results(results)
+
+    def iter_range_metric(self, name: str, start: str, end: str, step: str):
+        """
+        Stream the series of `get_range_metric` one at a time instead of
+        holding the whole matrix in memory. Label shards are queried one after
+        another and each response is parsed incrementally. Shards spanning
+        several sub-windows are stitched in memory, which is bounded by
+        `max_series_per_query`.
+        """
+        windows = split_time_range(start, end, step, self.max_points_per_series)
+        for query in self.plan_shard_queries(name, start, end):
+            if len(windows) == 1:
+                yield from self.stream_query_range(query, start, end, step)
+                continue
+            with ThreadPoolExecutor(
+                max_workers=min(len(windows), self.pool_maxsize)
+            ) as executor:
+                results = list(
+                    executor.map(
+                        lambda window: self.query_range(query, *window, step), windows
+                    )
+                )
+            data = merge_range_results(results)
+            if data is None:
+                raise ValueError(f"Fail to get range metric {query}!")
+            yield from data["result"]
+
+    def stream_query_range(self, name: str, start: str, end: str, step: str):
+        """Send a single range query and parse its series incrementally."""
         url = os.path.join(self.BASE_URL, "query_range")
         payload = {"query": name, "start": start, "end": end, "step": step}
-        for _ in range(3):
-            try:
-                r = requests.get(
-                    url, params=payload, auth=(self.username, self.password)
-                )
-                if r.status_code < 300:
-                    break
-                time.sleep(0.1)
-            except ConnectionError as e:
-                print(e.message)
-                time.sleep(120)
-                r = requests.get(
-                    url, params=payload, auth=(self.username, self.password)
-                )
-        r.raise_for_status()
+        with self.post(url, payload, stream=True) as r:
+            r.raw.decode_content = True
+            yield from ijson.items(r.raw, "data.result.item", use_float=True)
+
+    def query_range(self, name: str, start: str, end: str, step: str):
+        """Send a single range query, see `get_range_metric`."""
+        url = os.path.join(self.BASE_URL, "query_range")
+        payload = {"query": name, "start": start, "end": end, "step": step}
+        r = self.post(url, payload)
         json = r.json()
         if json["status"] == "success":
             return json["data"]
         else:
             print(f"Fail to get instant metric {name}. [JSON] {json}")
             return None
+
+
+class AsyncPrometheusAPI:
+    """Asynchronous Prometheus client sharing one keep-alive connection pool."""
+
+    BASE_URL = PrometheusAPI.BASE_URL
+
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        max_connections: int = 8,
+        timeout: tuple = REQUEST_TIMEOUT,
+        max_retries: int = MAX_RETRIES,
+        max_points_per_series: int = MAX_POINTS_PER_SERIES,
+        max_series_per_query: int = MAX_SERIES_PER_QUERY,
+    ):
+        self.auth = aiohttp.BasicAuth(username, password)
+        self.max_connections = max_connections
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=timeout[0], sock_read=timeout[1]
+        )
+        self.max_retries = max_retries
+        self.max_points_per_series = max_points_per_series
+        self.max_series_per_query = max_series_per_query
+        self.session = None
+
+    async def __aenter__(self) -> "AsyncPrometheusAPI":
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections, keepalive_timeout=60
+        )
+        self.session = aiohttp.ClientSession(
+            auth=self.auth,
+            connector=connector,
+            timeout=self.timeout,
+            headers={"Accept-Encoding": "gzip"},
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    @contextlib.asynccontextmanager
+    async def request(
+        self, method: str, url: str, params: dict = None, data: dict = None
+    ):
+        """
+        Asynchronous counterpart of `PrometheusAPI.request` yielding the
+        response with its body unread.
+        """
+        for attempt in range(self.max_retries):
+            is_last_attempt = attempt == self.max_retries - 1
+            try:
+                r = await self.session.request(method, url, params=params, data=data)
+                if (
+                    r.status < 300
+                    or not is_retryable_status(r.status)
+                    or is_last_attempt
+                ):
+                    break
+                r.release()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if is_last_attempt:
+                    raise
+                print(f"Retry request to {url} after error: {e!r}")
+            await asyncio.sleep(backoff_delay(attempt))
+        try:
+            r.raise_for_status()
+            yield r
+        finally:
+            r.release()
+
+    def get(self, url: str, params: dict = None):
+        return self.request("GET", url, params=params)
+
+    def post(self, url: str, data: dict):
+        """Send a form-encoded POST request, see `PrometheusAPI.post`."""
+        return self.request("POST", url, data=data)
+
+    async def post_json(self, url: str, data: dict) -> dict:
+        """Send a POST request with retries and decode the JSON body."""
+        async with self.post(url, data) as r:
+            return await r.json()
+
+    async def get_series(self, match: str, start: str, end: str) -> list:
+        """Get label sets of the series matching the selector over a range of time."""
+        url = os.path.join(self.BASE_URL, "series")
+        payload = {"match[]": match, "start": str(start), "end": str(end)}
+        json = await self.post_json(url, payload)
+        return json["data"]
+
+    async def plan_shard_queries(self, name: str, start: str, end: str) -> list:
+        """
+        Probe the series cardinality of a metric and shard it if necessary.
+        Sharding is disabled if `max_series_per_query` is None.
+        """
+        is_metric_name = METRIC_NAME_PATTERN.fullmatch(name) is not None
+        if self.max_series_per_query is None or not is_metric_name:
+            return [name]
+        series = await self.get_series(name, start, end)
+        return gen_shard_queries(name, series, self.max_series_per_query)
+
+    async def get_range_metric(self, name: str, start: str, end: str, step: str):
+        """
+        Get metric by name over a range of time, sharding it by label and
+        splitting it into concurrent sub-windows like
+        `PrometheusAPI.get_range_metric`.
+
+        Parameters
+        ----------
+        name : the name of the collected metric
+        start : start Unix timestamp in seconds, inclusive
+        end : end Unix timestamp in seconds, inclusive
+        step : query resolution step width in Prometheus duration string format
+        """
+        queries = await self.plan_shard_queries(name, start, end)
+        windows = split_time_range(start, end, step, self.max_points_per_series)
+        if len(queries) == 1 and len(windows) == 1:
+            return await self.query_range(name, start, end, step)
+        results = await asyncio.gather(
+            *[
+                self.query_range(query, *window, step)
+                for query in queries
+                for window in windows
+            ]
+        )
+        return merge_range_results(results)
+
+    async def iter_range_metric(self, name: str, start: str, end: str, step: str):
+        """Asynchronous counterpart of `PrometheusAPI.iter_range_metric`."""
+        windows = split_time_range(start, end, step, self.max_points_per_series)
+        for query in await self.plan_shard_queries(name, start, end):
+            if len(windows) == 1:
+                url = os.path.join(self.BASE_URL, "query_range")
+                payload = {
+                    "query": query,
+                    "start": str(start),
+                    "end": str(end),
+                    "step": step,
+                }
+                async with self.post(url, payload) as r:
+                    async for item in ijson.items(
+                        r.content, "data.result.item", use_float=True
+                    ):
+                        yield item
+                continue
+            results = await asyncio.gather(
+                *[self.query_range(query, *window, step) for window in windows]
+            )
+            data = merge_range_results(results)
+            if data is None:
+                raise ValueError(f"Fail to get range metric {query}!")
+            for item in data["result"]:
+                yield item
+
+    async def query_range(self, name: str, start: str, end: str, step: str):
+        """Send a single range query, see `get_range_metric`."""
+        url = os.path.join(self.BASE_URL, "query_range")
+        payload = {"query": name, "start": str(start), "end": str(end), "step": step}
+        json = await self.post_json(url, payload)
+        if json["status"] == "success":
+            return json["data"]
+        else:
+            print(f"Fail to get range metric {name}. [JSON] {json}")
+            return None
@@ -2,6 +2,7 @@ import os
 import numpy as np
 import plotly.express as px
 import pandas as pd
+from app.processing.matrix_io import find_columns, read_matrix
 
 
 def visualize_metrics_dynamics(df, title):
@@ -32,13 +33,19 @@ def visualize_faulty_metrics(metrics_path: str, experiment_name: str):
 
 
 def visualize_network_metrics(metrics_path: str, experiment_name: str):
-    df_faulty = pd.read_csv(metrics_path).set_index("timestamp")
-    df_faulty.index = pd.to_datetime(df_faulty.index)
-    cols = [
-        col
-        for col in df_faulty.columns
-        if "pm-11-alms-core-userapi" in col or "pm-12" in col
-    ]
+    network_metrics = ["pm-11-alms-core-userapi", "pm-12"]
+    if metrics_path.endswith(".parquet"):
+        # read only columns of network metrics
+        cols = find_columns(metrics_path, substrings=network_metrics)
+        df_faulty = read_matrix(metrics_path, cols).astype(float)
+    else:
+        df_faulty = pd.read_csv(metrics_path).set_index("timestamp")
+        df_faulty.index = pd.to_datetime(df_faulty.index)
+        cols = [
+            col
+            for col in df_faulty.columns
+            if any(metric in col for metric in network_metrics)
+        ]
     visualize_metrics_dynamics(df_faulty[cols], "network-metrics-" + experiment_name)
 
 
@@ -0,0 +1,73 @@
+import json
+import os
+
+import jsonlines
+import numpy as np
+import pandas as pd
+
+from app.model.gmetric import GMetric
+from app.processing.gcloud.data_aggregate import GCloudAgg
+from app.processing.gcloud.data_preprocess import (
+    merge_normal_gcloud_kpis_for_same_metric,
+)
+
+BUCKET_BOUNDS = [0.0, 10.0, 20.0, 30.0]
+
+
+def write_distribution_day(folder: str, kpi_indices: dict, start: int):
+    """Write one day of a distribution metric type in the CSV layout of `GMetric`."""
+    kpi_dir = os.path.join("gcloud-metrics", folder, "metric-type-1")
+    os.makedirs(kpi_dir)
+    with open(os.path.join(kpi_dir, GMetric.BUCKET_BOUNDS_FNAME), "w") as fp:
+        json.dump(BUCKET_BOUNDS, fp)
+    with jsonlines.open(os.path.join(kpi_dir, GMetric.KPI_MAP_FNAME), "w") as writer:
+        for pod_name, kpi_index in kpi_indices.items():
+            writer.write(
+                {"index": kpi_index, "kpi": {"pod_name": pod_name, "zone": "a"}}
+            )
+    timestamps = start + 60 * np.arange(3)
+    for pod_name, kpi_index in kpi_indices.items():
+        # all samples of pod-1 are in [0, 10), all samples of pod-2 in [10, 20)
+        bucket_counts = np.zeros((len(timestamps), len(BUCKET_BOUNDS) + 1), np.int64)
+        bucket_counts[:, 1 if pod_name == "pod-1" else 2] = 10
+        pd.DataFrame(
+            {
+                "timestamp": timestamps,
+                "count": 10.0,
+                "mean": 5.0,
+                "sum_of_squared_deviation": 1.0,
+            }
+        ).to_csv(os.path.join(kpi_dir, f"kpi-{kpi_index}.csv"), index=False)
+        np.save(os.path.join(kpi_dir, f"kpi-{kpi_index}-buckets.npy"), bucket_counts)
+
+
+def test_normal_merge_keeps_histograms_for_quantiles(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("gcloud-metrics")
+    pd.DataFrame({"index": [1], "name": ["latencies"], "kind": [2]}).to_csv(
+        os.path.join("gcloud-metrics", "metric_type_map.csv"), index=False
+    )
+    # KPI indices of the same pods differ between days
+    write_distribution_day("gcloud_metrics-day-1", {"pod-1": 1, "pod-2": 2}, 0)
+    write_distribution_day("gcloud_metrics-day-2", {"pod-2": 1, "pod-1": 2}, 86400)
+
+    merge_normal_gcloud_kpis_for_same_metric()
+    combined_path = os.path.join("gcloud-metrics", "gcloud_combined")
+    assert os.path.exists(os.path.join(combined_path, "metric-1-buckets.npz"))
+
+    aggregated_path = os.path.join("gcloud-metrics", "gcloud_aggregated")
+    gcloud_agg = GCloudAgg(
+        combined_path,
+        os.path.join("gcloud-metrics", "gcloud_round_time"),
+        aggregated_path,
+    )
+    gcloud_agg.aggregate_by_minute()
+    gcloud_agg.perform_aggregation_for_all_metrics()
+
+    df_agg = pd.read_csv(os.path.join(aggregated_path, "metric-1.csv"))
+    assert len(df_agg) == 6
+    # both pods are merged into one histogram with half of the samples in
+    # [0, 10) and half in [10, 20) on every minute of both days
+    np.testing.assert_allclose(df_agg["agg-kpi-1-p50"], 10.0)
+    np.testing.assert_allclose(df_agg["agg-kpi-1-p90"], 18.0)
+    np.testing.assert_allclose(df_agg["agg-kpi-1-p99"], 19.8)
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from app.processing.matrix_io import iter_aligned_chunks, write_time_series
+
+
+def test_iter_aligned_chunks_drops_rows_before_first_timestamp(tmp_path, monkeypatch):
+    # the source starts a week before the Locust run, which lasts 50 minutes
+    index = pd.date_range("2023-01-01", periods=7 * 1440 + 60, freq="min")
+    df_source = pd.DataFrame(
+        {"kpi-1": np.arange(len(index), dtype=np.float64)},
+        index=pd.Index(index, name="timestamp"),
+    )
+    path = str(tmp_path / "source")
+    write_time_series(df_source, path)
+    locust_timestamps = index[-55:-5]
+    timestamp_chunks = [
+        locust_timestamps[start : start + 10]
+        for start in range(0, len(locust_timestamps), 10)
+    ]
+
+    max_buffered_rows = 0
+    concat = pd.concat
+
+    def concat_and_count(objs, *args, **kwargs):
+        nonlocal max_buffered_rows
+        df = concat(objs, *args, **kwargs)
+        max_buffered_rows = max(max_buffered_rows, len(df))
+        return df
+
+    monkeypatch.setattr(pd, "concat", concat_and_count)
+    chunks = list(iter_aligned_chunks(path, "csv", timestamp_chunks, chunk_size=20))
+
+    assert max_buffered_rows <= 40
+    pd.testing.assert_frame_equal(
+        pd.concat(chunks),
+        df_source.reindex(locust_timestamps),
+        check_freq=False,
+    )
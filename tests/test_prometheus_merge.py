@@ -0,0 +1,58 @@
+import json
+import os
+
+import pandas as pd
+
+from app.processing.prometheus import data_merge
+
+
+def write_aggregated_metric(aggregate_output_path: str, offset: float):
+    """Write an aggregated metric 0 with a constant and a varying KPI."""
+    os.makedirs(aggregate_output_path)
+    with open(os.path.join(aggregate_output_path, "metric-0-kpi-map.json"), "w") as fp:
+        json.dump(
+            [
+                {"index": 1, "kpi": {"pod": "a"}},
+                {"index": 2, "kpi": {"pod": "b"}},
+            ],
+            fp,
+        )
+    pd.DataFrame(
+        {
+            "timestamp": pd.date_range("2023-01-01", periods=4, freq="min"),
+            "agg-kpi-1": 1.0,
+            "agg-kpi-2": [offset, offset + 1, offset + 2, offset + 3],
+        }
+    ).to_csv(os.path.join(aggregate_output_path, "metric-0.csv"), index=False)
+
+
+def test_merge_individual_metric_writes_into_its_output_path(tmp_path, monkeypatch):
+    target_metric_names_path = tmp_path / "target_metrics.csv"
+    pd.DataFrame({"name": ["cpu"]}).to_csv(target_metric_names_path, index=False)
+    monkeypatch.setattr(
+        data_merge, "TARGET_METRIC_NAMES_PATH", str(target_metric_names_path)
+    )
+    default_output_path = tmp_path / "prometheus_merged"
+    monkeypatch.setattr(data_merge, "MERGE_OUTPUT_PATH", str(default_output_path))
+
+    for exp_name, offset in [("exp-1", 0.0), ("exp-2", 10.0)]:
+        aggregate_output_path = str(tmp_path / exp_name / "aggregated")
+        write_aggregated_metric(aggregate_output_path, offset)
+        data_merge.merge_individual_metric(
+            str(tmp_path / exp_name / "merged"), aggregate_output_path
+        )
+
+    assert not default_output_path.exists()
+    for exp_name, offset in [("exp-1", 0.0), ("exp-2", 10.0)]:
+        merge_output_path = tmp_path / exp_name / "merged"
+        with open(merge_output_path / "metric-0-pruned.json") as fp:
+            pruned = json.load(fp)
+        assert pruned["constant"] == {"pm-0-agg-kpi-1": 1.0}
+        df_metric = pd.read_csv(merge_output_path / "metric-0.csv", index_col=0)
+        assert df_metric["pm-0-agg-kpi-2"].to_list() == [
+            offset,
+            offset + 1,
+            offset + 2,
+            offset + 3,
+        ]
+        assert (merge_output_path / "prom-complete-time-series.csv").exists()